@@ -0,0 +1,76 @@
+import os
+import shutil
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+from omegadl.library import record_archive
+
+
+class ChapterArchive:
+    """
+    Writes the pages of a chapter straight into its .cbz as they arrive, without
+    an intermediate directory. The archive is written under a temporary name and
+    only renamed to its final name on commit, so a half written chapter is never
+    mistaken for a downloaded one. Images are already compressed and are stored
+    as is, everything else is deflated.
+    """
+
+    STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".avif")
+
+    def __init__(self, path:Path):
+        self.path = Path(path)
+        self.partial = self.path.with_name(f"{self.path.name}.part")
+
+        os.makedirs(self.path.parent, exist_ok=True)
+        self._zip = zipfile.ZipFile(self.partial, "w")
+        self._lock = threading.Lock()
+
+    def _info(self, name:str) -> zipfile.ZipInfo:
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        if name.lower().endswith(self.STORED_EXTENSIONS):
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        return info
+
+    def write(self, name:str, data:bytes):
+        """
+        Adds a file with the given contents to the archive.
+        """
+        with self._lock:
+            self._zip.writestr(self._info(name), data)
+
+    def write_stream(self, name:str, fileobj, chunk_size:int=64*1024):
+        """
+        Copies a file object into the archive without reading it into memory.
+        """
+        with self._lock:
+            with self._zip.open(self._info(name), "w", force_zip64=True) as dest:
+                shutil.copyfileobj(fileobj, dest, chunk_size)
+
+    def commit(self):
+        """
+        Finishes the archive and moves it to its final name.
+        """
+        self._zip.close()
+        os.replace(self.partial, self.path)
+        record_archive(self.path)
+
+    def abort(self):
+        """
+        Discards the partially written archive.
+        """
+        self._zip.close()
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
@@ -0,0 +1,303 @@
+import atexit
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+from collections import namedtuple
+
+from omegadl.objects import Config
+
+
+ENDPOINTS = ("query", "chapter_list", "chapter_pages", "other")
+REVALIDATED_ENDPOINTS = ("query", "chapter_list")
+
+CacheEntry = namedtuple("CacheEntry", ["body", "fetched_at", "etag", "last_modified", "digest", "stored_at"])
+# stored_at is when the body was last written, fetched_at also moves on revalidation.
+
+_caches: dict[Path, "ResponseCache"] = {}
+_caches_lock = threading.Lock()
+
+_settings = {
+    "ttls": {"query": 3600, "chapter_list": 3600, "chapter_pages": None, "other": None},
+    "max_bytes": 512 * 1024 * 1024,
+    "revalidate": False,
+}
+
+
+def configure(config:Config):
+    """
+    Applies the cache ttls and size limit from the config.
+    """
+    _settings["ttls"] = {**_settings["ttls"], **config.cache_ttls}
+    _settings["max_bytes"] = config.cache_max_mb * 1024 * 1024
+    _settings["revalidate"] = config.cache_revalidate
+
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.ttls = _settings["ttls"]
+            cache.max_bytes = _settings["max_bytes"]
+
+
+def get_cache(output_dir:Path) -> "ResponseCache":
+    """
+    Returns the response cache stored in the given output directory.
+    """
+    path = Path(output_dir) / "cache" / "requests.db"
+
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResponseCache(path, ttls=_settings["ttls"], max_bytes=_settings["max_bytes"])
+        return _caches[path]
+
+
+def revalidates(url:str) -> bool:
+    """
+    Returns True if cached responses for the url should be revalidated with the
+    server instead of being served until their ttl runs out.
+    """
+    return _settings["revalidate"] and classify(url)[0] in REVALIDATED_ENDPOINTS
+
+
+def digest(body:str) -> str:
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+
+def classify(url:str) -> tuple[str, str]:
+    """
+    Returns the (endpoint, comic) pair a request url belongs to. The comic is the
+    series id for chapter lists and the series slug for chapter pages.
+    """
+    parts = urlsplit(url)
+    path = parts.path.strip("/").split("/")
+
+    if path == ["query"]:
+        return "query", None
+    if path == ["chapter", "query"]:
+        return "chapter_list", parse_qs(parts.query).get("series_id", [None])[0]
+    if len(path) == 3 and path[0] == "chapter":
+        return "chapter_pages", path[1]
+    return "other", None
+
+
+class ResponseCache:
+    """
+    Single file, indexed store for api responses. Bodies are zlib compressed and
+    entries expire according to the ttl of their endpoint. Once the store grows
+    past max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, path:Path, ttls:dict, max_bytes:int):
+        self.path = path
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.hits = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.misses = {endpoint: 0 for endpoint in ENDPOINTS}
+
+        self._lock = threading.Lock()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                comic TEXT,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                digest TEXT,
+                stored_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS responses_endpoint ON responses (endpoint, comic);
+            CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at);
+            CREATE INDEX IF NOT EXISTS responses_fetched ON responses (fetched_at);
+            CREATE TABLE IF NOT EXISTS counters (
+                endpoint TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL,
+                misses INTEGER NOT NULL
+            );
+        """)
+        self._migrate()
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        atexit.register(self.close)
+
+    def _migrate(self):
+        # Stores created before validators were kept lack these columns.
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(responses)")]
+        for column in ("etag", "last_modified", "digest"):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE responses ADD COLUMN {column} TEXT")
+        # Entries stored before body write times were kept have a stored_at of None.
+        if "stored_at" not in columns:
+            self._db.execute("ALTER TABLE responses ADD COLUMN stored_at REAL")
+
+    def _expired(self, endpoint:str, fetched_at:float) -> bool:
+        ttl = self.ttls.get(endpoint)
+        return ttl is not None and time.time() - fetched_at > ttl
+
+    def get(self, url:str) -> str:
+        """
+        Returns the cached body for the url or None if it is missing or expired.
+        """
+        endpoint, _ = classify(url)
+
+        with self._lock:
+            row = self._db.execute("SELECT body, fetched_at FROM responses WHERE url = ?", (url,)).fetchone()
+
+            if row is None or self._expired(endpoint, row[1]):
+                self.misses[endpoint] += 1
+                return None
+
+            self.hits[endpoint] += 1
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self._db.commit()
+
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def lookup(self, url:str) -> CacheEntry:
+        """
+        Returns the cached entry for the url along with its validators, whether it
+        has expired or not. Does not count as a hit or a miss.
+        """
+        with self._lock:
+            row = self._db.execute("""
+                SELECT body, fetched_at, etag, last_modified, digest, stored_at FROM responses WHERE url = ?
+            """, (url,)).fetchone()
+
+        if row is None:
+            return None
+        return CacheEntry(zlib.decompress(row[0]).decode("utf-8"), *row[1:])
+
+    def touch(self, url:str):
+        """
+        Marks the cached entry for the url as fresh after the server confirmed it
+        is unchanged. Counts as a hit.
+        """
+        endpoint, _ = classify(url)
+        now = time.time()
+
+        with self._lock:
+            self.hits[endpoint] += 1
+            self._db.execute("UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+            self._db.commit()
+
+    def record_miss(self, url:str):
+        with self._lock:
+            self.misses[classify(url)[0]] += 1
+
+    def put(self, url:str, body:str, etag:str=None, last_modified:str=None):
+        """
+        Stores the body for the url along with its validators, evicting old 
+        entries if the store is full.
+        """
+        endpoint, comic = classify(url)
+        blob = zlib.compress(body.encode("utf-8"))
+        now = time.time()
+
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            if previous is not None:
+                self._size -= previous[0]
+
+            self._db.execute("""
+                INSERT OR REPLACE INTO responses 
+                (url, endpoint, comic, body, size, fetched_at, accessed_at, etag, last_modified, digest, stored_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (url, endpoint, comic, blob, len(blob), now, now, etag, last_modified, digest(body), now))
+            self._size += len(blob)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+
+        cursor = self._db.execute("SELECT url, size FROM responses ORDER BY accessed_at")
+        evicted = []
+        for url, size in cursor:
+            if self._size <= self.max_bytes:
+                break
+            evicted.append((url,))
+            self._size -= size
+
+        self._db.executemany("DELETE FROM responses WHERE url = ?", evicted)
+
+    def purge(self, endpoint:str=None, comics:list[str]=None, older_than:float=None) -> int:
+        """
+        Deletes the cached responses matching all of the given filters and returns
+        how many were removed. Without any filter the whole store is emptied.
+        #   endpoint: One of ENDPOINTS
+        #   comics: Series ids or slugs the responses belong to
+        #   older_than: Age in seconds
+        """
+        clauses = []
+        params = []
+
+        if endpoint is not None:
+            clauses.append("endpoint = ?")
+            params.append(endpoint)
+
+        if comics is not None:
+            clauses.append(f"comic IN ({', '.join('?' * len(comics))})")
+            params.extend(str(x) for x in comics)
+
+        if older_than is not None:
+            clauses.append("fetched_at < ?")
+            params.append(time.time() - older_than)
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        with self._lock:
+            removed = self._db.execute(f"DELETE FROM responses {where}", params).rowcount
+            self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            self._db.commit()
+            self._db.execute("VACUUM")
+
+        return removed
+
+    def stats(self) -> dict:
+        """
+        Returns the number of entries, their size and the hit/miss counters
+        (including earlier runs) for every endpoint.
+        """
+        with self._lock:
+            self._flush_counters()
+            rows = self._db.execute("""
+                SELECT endpoint, COUNT(*), SUM(size) FROM responses GROUP BY endpoint
+            """).fetchall()
+            counters = self._db.execute("SELECT endpoint, hits, misses FROM counters").fetchall()
+
+        stats = {endpoint: {"entries": 0, "bytes": 0, "hits": 0, "misses": 0} for endpoint in ENDPOINTS}
+        for endpoint, entries, size in rows:
+            stats[endpoint].update(entries=entries, bytes=size)
+        for endpoint, hits, misses in counters:
+            stats[endpoint].update(hits=hits, misses=misses)
+
+        return stats
+
+    def _flush_counters(self):
+        for endpoint in ENDPOINTS:
+            self._db.execute("""
+                INSERT INTO counters VALUES (?, ?, ?) ON CONFLICT(endpoint)
+                DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses
+            """, (endpoint, self.hits[endpoint], self.misses[endpoint]))
+            self.hits[endpoint] = 0
+            self.misses[endpoint] = 0
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            self._flush_counters()
+            self._db.close()
+            self._db = None
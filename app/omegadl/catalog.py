@@ -1,45 +1,297 @@
 from pathlib import Path
 from datetime import datetime
 import json
+import os
+import threading
 
 from omegadl.objects import Comic, dict_to_comic, ComicStatus
+from omegadl.catalogdb import CatalogDatabase
+from omegadl.catalogindex import IndexedCatalog, write_catalog, read_index
+from omegadl.search import TitleIndex, load_title_index, write_title_index
 
 
-# TODO: Use catalog as an object
 # TODO: Implement subscription list
 
-def load_catalog(output_dir:Path):
+
+class Catalog:
+    """
+    In memory comic catalog. Comics are kept in catalog order and indexed by
+    id, slug and status. The indexes are kept up to date by insert(), replace()
+    and remove(), so comics must not be added or removed any other way.
+    """
+
+    def __init__(self, comics=(), sync_time:str=None, title_index_path:Path=None, watermark:str=None):
+        self.sync_time = sync_time
+        self.watermark = watermark
+        # The latest updated_at of the comics when the catalog was last synced.
+        self.title_index_path = title_index_path
+        # Built on the first search and then kept up to date along with the
+        # other indexes.
+        self.title_index: TitleIndex = None
+        self._comics: dict[int, Comic] = {}
+        self._by_slug: dict[str, Comic] = {}
+        self._by_status: dict[ComicStatus, dict[int, Comic]] = {status: {} for status in ComicStatus}
+        # The slug and status each comic was indexed under, so that comics 
+        # changed in place can still be found in the indexes.
+        self._keys: dict[int, tuple[str, ComicStatus]] = {}
+
+        for comic in comics:
+            self.insert(comic)
+
+    def __len__(self) -> int:
+        return len(self._comics)
+
+    def __iter__(self):
+        return iter(list(self._comics.values()))
+
+    def __contains__(self, id) -> bool:
+        return id in self._comics
+
+    def _index(self, comic:Comic):
+        self._keys[comic.id] = (comic.slug, comic.status)
+        self._by_slug[comic.slug] = comic
+        self._by_status[comic.status][comic.id] = comic
+        if self.title_index is not None:
+            self.title_index.add(comic.id, comic.name, comic.slug)
+
+    def _unindex(self, id):
+        slug, status = self._keys.pop(id)
+        if slug in self._by_slug and self._by_slug[slug].id == id:
+            del self._by_slug[slug]
+        del self._by_status[status][id]
+        if self.title_index is not None:
+            self.title_index.remove(id)
+
+    def insert(self, comic:Comic):
+        """
+        Adds a comic at the end of the catalog, or replaces the comic with the
+        same id in place.
+        """
+        if comic.id in self._comics:
+            self.replace(comic)
+            return
+
+        self._comics[comic.id] = comic
+        self._index(comic)
+
+    def replace(self, comic:Comic):
+        """
+        Replaces the comic with the same id, keeping its position. Also needs to
+        be called after changing the slug or status of a comic in the catalog.
+        """
+        if comic.id not in self._comics:
+            raise KeyError(comic.id)
+
+        self._unindex(comic.id)
+        self._comics[comic.id] = comic
+        self._index(comic)
+
+    def remove(self, id) -> Comic:
+        self._unindex(id)
+        return self._comics.pop(id)
+
+    def load_all(self) -> list[Comic]:
+        return list(self._comics.values())
+
+    def get_by_id(self, id) -> Comic:
+        return self._comics.get(id)
+
+    def get_by_slug(self, slug:str) -> Comic:
+        return self._by_slug.get(slug)
+
+    def titles(self):
+        return [(comic.id, comic.name, comic.slug) for comic in self._comics.values()]
+
+    def search(self, query:str, limit:int=10, status:ComicStatus=None) -> list[Comic]:
+        """
+        Returns up to limit comics best matching the query, see TitleIndex. 
+        Only comics with the given status are returned, if any.
+        """
+        if self.title_index is None:
+            self.title_index = load_title_index(self.title_index_path, self.sync_time, self.titles)
+        accept = (lambda id: self._comics[id].status == status) if status is not None else None
+        return [self._comics[id] for id in self.title_index.search(query, limit, accept)]
+
+    def find_by_name(self, query:str, status:ComicStatus=None) -> Comic:
+        comics = self.search(query, 1, status)
+        return comics[0] if comics else None
+
+    def with_status(self, status:ComicStatus) -> list[Comic]:
+        return list(self._by_status[status].values())
+
+
+# Catalogs that answer lookups themselves instead of being scanned.
+INDEXED_CATALOGS = (Catalog, CatalogDatabase, IndexedCatalog)
+
+_databases: dict[Path, CatalogDatabase] = {}
+_databases_lock = threading.Lock()
+
+
+def get_catalog_path(output_dir:Path, backend:str="json") -> Path:
+    if backend == "sqlite":
+        return output_dir / "catalog.db"
+    return output_dir / "catalog.json"
+
+
+def get_index_path(output_dir:Path) -> Path:
+    return output_dir / "catalog.index.json"
+
+
+def get_title_index_path(output_dir:Path) -> Path:
+    return output_dir / "catalog.titles.json"
+
+
+def get_catalog_database(output_dir:Path) -> CatalogDatabase:
+    """
+    Returns the sqlite catalog stored in the given output directory.
+    """
+    path = get_catalog_path(Path(output_dir), "sqlite")
+
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = CatalogDatabase(path, get_title_index_path(Path(output_dir)))
+        return _databases[path]
+
+
+def get_indexed_catalog(output_dir:Path) -> IndexedCatalog:
+    """
+    Returns catalog.json read through its offset index, or None if the index
+    is missing or out of date.
+    """
+    catalog_json = get_catalog_path(output_dir, "json")
+    index = read_index(catalog_json, get_index_path(output_dir))
+    if index is None:
+        return None
+    return IndexedCatalog(catalog_json, index, get_title_index_path(output_dir))
+
+
+def open_catalog(output_dir:Path, backend:str="json"):
     """
-    Loads the comic catalog from given output directory
+    Returns a catalog that search_comics() can look comics up in. With the
+    sqlite backend, or a json catalog with an up to date index, single comic 
+    lookups do not load the whole catalog.
     """
+    if backend == "sqlite":
+        return get_catalog_database(output_dir)
+
+    catalog = get_indexed_catalog(output_dir)
+    if catalog is not None:
+        return catalog
+    return load_catalog(output_dir)[0]
+
+
+def load_catalog(output_dir:Path, backend:str="json"):
+    """
+    Loads the comic catalog from given output directory as a Catalog, along with
+    the time it was last synced. If catalog.json has an up to date index, the
+    chapters of each comic are only parsed once they are accessed. Catalogs
+    written before watermarks were stored have a watermark of None.
+    """
+    if backend == "sqlite":
+        database = get_catalog_database(output_dir)
+        return (Catalog(database.load_all(), database.sync_time, get_title_index_path(output_dir), 
+                        database.watermark), database.sync_time)
+
+    catalog = get_indexed_catalog(output_dir)
+    if catalog is not None:
+        return (Catalog(catalog.load_all(), catalog.sync_time, get_title_index_path(output_dir), 
+                        catalog.watermark), catalog.sync_time)
+
     catalog_json = output_dir / "catalog.json"
 
     with open(catalog_json, "r") as f:
         comic_store = json.loads(f.read())
 
-    comics = []
-    for comic in comic_store["data"]:
-        comics.append(dict_to_comic(comic))
-
     sync_time = comic_store["meta"]["fetched"]
+    comics = Catalog((dict_to_comic(comic) for comic in comic_store["data"]), sync_time, 
+                     get_title_index_path(output_dir), comic_store["meta"].get("watermark"))
 
     return comics, sync_time
 
-def dump_catalog(output_dir:Path, comic_list:list[Comic]):
+
+def iter_catalog(output_dir:Path, backend:str="json"):
     """
-    Dumps the comic catalog at a given output directory
+    Yields the comics of the catalog one at a time along with their chapters,
+    for jobs that go through the whole catalog without keeping it in memory.
     """
-    catalog_json = output_dir / "catalog.json"
+    if backend == "sqlite":
+        yield from get_catalog_database(output_dir).iter_comics()
+        return
+
+    catalog = get_indexed_catalog(output_dir)
+    if catalog is not None:
+        yield from catalog.iter_comics()
+        return
+
+    yield from load_catalog(output_dir)[0]
+
+
+def dump_catalog(output_dir:Path, comic_list:list[Comic], backend:str="json", updated:set=None, 
+                 watermark:str=None):
+    """
+    Dumps the comic catalog at a given output directory, along with its offset
+    index for the json backend and its title index.
+    #   backend: "json" or "sqlite"
+    #   updated: Ids of the comics whose chapters changed. The sqlite backend 
+    #            only rewrites the chapters of these comics. None for all.
+    #   watermark: Stored instead of the latest updated_at of the comics, for
+    #              catalogs that were not brought up to date entirely.
+    """
+    fetched = str(datetime.now())
+    title_index = TitleIndex()
+
+    def index_titles(comics):
+        for comic in comics:
+            title_index.add(comic.id, comic.name, comic.slug)
+            yield comic
+
+    if backend == "sqlite":
+        get_catalog_database(output_dir).upsert(index_titles(comic_list), updated, fetched, watermark)
+    else:
+        write_catalog(get_catalog_path(output_dir, "json"), get_index_path(output_dir), index_titles(comic_list), 
+                      fetched, watermark)
+
+    write_title_index(get_title_index_path(output_dir), title_index, fetched)
+
 
-    comic_list = [comic.encode() for comic in comic_list]
+def get_journal_path(output_dir:Path) -> Path:
+    return output_dir / "catalog.journal.jsonl"
 
-    with open(catalog_json, "w") as f:
-        f.write(json.dumps({
-            "meta": {
-                "fetched": str(datetime.now())
-            },
-            "data": comic_list
-        }, default=vars))
+
+def append_to_journal(output_dir:Path, comic:Comic):
+    """
+    Appends a completed comic to the catalog generation journal. The line is
+    flushed to disk before returning so that it survives the process dying.
+    """
+    with open(get_journal_path(output_dir), "a") as f:
+        f.write(json.dumps(comic.encode(), default=vars) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_journal(output_dir:Path) -> list[Comic]:
+    """
+    Returns the comics recorded in the catalog generation journal. A trailing
+    line cut short by a crash is ignored.
+    """
+    journal = get_journal_path(output_dir)
+    if not os.path.exists(journal):
+        return []
+
+    comics = []
+    with open(journal, "r") as f:
+        for line in f:
+            try:
+                comics.append(dict_to_comic(json.loads(line)))
+            except json.JSONDecodeError:
+                break
+
+    return comics
+
+
+def clear_journal(output_dir:Path):
+    if os.path.exists(get_journal_path(output_dir)):
+        os.remove(get_journal_path(output_dir))
 
 
 def store_to_comic_names(catalog:list) -> list:
@@ -51,10 +303,23 @@ def store_to_comic_names(catalog:list) -> list:
     for comic in catalog:
         comic_names.append(comic["name"].lower())
 
+def migrate_catalog(output_dir:Path) -> int:
+    """
+    Copies the json catalog into the sqlite catalog and returns the number of 
+    comics migrated. The json catalog is left in place.
+    """
+    comics = iter_catalog(output_dir, "json")
+    dump_catalog(output_dir, comics, "sqlite")
+    return len(get_catalog_database(output_dir))
+
+
 def get_comic_by_name(catalog:list[Comic], query:str) -> dict:
     """
     Search comics by name
     """
+    if isinstance(catalog, INDEXED_CATALOGS):
+        return catalog.find_by_name(query)
+
     query = query.lower().replace(" ", "")
 
     # TODO: Improve name matching.
@@ -68,45 +333,64 @@ def get_comic_by_id(catalog:list[Comic], search_id:str) -> Comic:
     """
     Search comics by id
     """
+    if isinstance(catalog, INDEXED_CATALOGS):
+        return catalog.get_by_id(search_id)
+
     for comic in catalog:
         if comic.id == search_id:
             return comic
 
 
-def search_comics(catalog, query) -> list[Comic]:
+def search_comics(catalog, query, limit:int=1) -> list[Comic]:
+    """
+    Returns the comics matching a comma separated list of queries. Each query
+    is a comic id, a title, ":all" or ":subscribed", optionally followed by a
+    "?status=" filter.
+    #   limit: Number of ranked candidates returned for each title query
+    """
     queries = query.split(",")
     filtered_comics = []
+    indexed = isinstance(catalog, INDEXED_CATALOGS)
+    # A status filter applies to its query and every query after it. Indexed
+    # catalogs apply it during the lookup, so that their indexes are still used.
+    status = None
+
+    def has_status(comic:Comic) -> bool:
+        return status is None or (comic is not None and comic.status == status)
 
     # TODO: Add proper filters
     # Make it so that it splits the query string with ? then it 
     # splits the filters string with & then processes it.
     for query in queries:
         if "?status=" in query:
-            status_filter = query.split("?status=")[-1]
-            filtered_catalog = []
-            for _comic in catalog:
-                if _comic.status == ComicStatus(status_filter):
-                    filtered_catalog.append(_comic)
-            catalog = filtered_catalog
+            status = ComicStatus(query.split("?status=")[-1])
 
         query = query.split("?")[0]
 
         # If all comics need to be filtered through
         if query == ":all":
-            return catalog
+            if status is not None and indexed:
+                return catalog.with_status(status)
+            return [comic for comic in catalog if has_status(comic)]
         
         # If only subscribed comics need to be filtered
         if query == ":subscribed":
             for comic in catalog:
-                if comic.is_subscribed:
+                if comic.is_subscribed and has_status(comic):
                     filtered_comics.append(comic)
             continue
 
         try:
             query = int(query)
         except:
-            filtered_comics.append(get_comic_by_name(catalog, query))
+            if indexed and limit > 1:
+                filtered_comics.extend(catalog.search(query, limit, status))
+            elif indexed:
+                filtered_comics.append(catalog.find_by_name(query, status))
+            else:
+                filtered_comics.append(get_comic_by_name([comic for comic in catalog if has_status(comic)], query))
         else:
-            filtered_comics.append(get_comic_by_id(catalog, query))
+            comic = get_comic_by_id(catalog, query)
+            filtered_comics.append(comic if has_status(comic) else None)
     
     return filtered_comics
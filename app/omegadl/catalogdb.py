@@ -0,0 +1,265 @@
+import atexit
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from omegadl.objects import Comic, Chapter, ComicStatus
+from omegadl.search import TitleIndex, load_title_index
+
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS comics (
+        id INTEGER PRIMARY KEY,
+        position INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        slug TEXT NOT NULL,
+        status TEXT NOT NULL,
+        created_at TEXT,
+        updated_at TEXT,
+        covers TEXT NOT NULL,
+        volume_breakpoints TEXT NOT NULL,
+        paywalled TEXT NOT NULL DEFAULT '[]'
+    );
+    CREATE INDEX IF NOT EXISTS comics_slug ON comics (slug);
+    CREATE INDEX IF NOT EXISTS comics_status ON comics (status);
+    CREATE INDEX IF NOT EXISTS comics_position ON comics (position);
+    CREATE INDEX IF NOT EXISTS comics_name ON comics (name COLLATE NOCASE);
+
+    CREATE TABLE IF NOT EXISTS chapters (
+        id INTEGER NOT NULL,
+        comic_id INTEGER NOT NULL REFERENCES comics (id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        name TEXT,
+        slug TEXT NOT NULL,
+        thumbnail_url TEXT,
+        created_at TEXT,
+        PRIMARY KEY (comic_id, position)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS pages (
+        comic_id INTEGER NOT NULL,
+        chapter_position INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        PRIMARY KEY (comic_id, chapter_position, position),
+        FOREIGN KEY (comic_id, chapter_position) REFERENCES chapters (comic_id, position) ON DELETE CASCADE
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+
+
+class CatalogDatabase:
+    """
+    SQLite backend for the comic catalog. Comics, chapters and pages live in
+    their own tables, so looking up a single comic by id, slug or name only
+    reads that comic's rows instead of parsing the whole catalog.
+    """
+
+    def __init__(self, path:Path, title_index_path:Path=None):
+        self.path = path
+        self.title_index_path = title_index_path
+        self.title_index: TitleIndex = None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.executescript(SCHEMA)
+        # Databases created before paywalled chapters were stored.
+        if "paywalled" not in {row[1] for row in self._db.execute("PRAGMA table_info(comics)")}:
+            self._db.execute("ALTER TABLE comics ADD COLUMN paywalled TEXT NOT NULL DEFAULT '[]'")
+        self._db.commit()
+        atexit.register(self.close)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @property
+    def sync_time(self) -> str:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'fetched'").fetchone()
+        return row[0] if row is not None else None
+
+    @property
+    def watermark(self) -> str:
+        """
+        The latest updated_at of the comics in the catalog when it was written.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        return row[0] if row is not None else None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM comics").fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.load_all())
+
+    def iter_comics(self):
+        """
+        Yields every comic one at a time, so that the whole catalog is never in
+        memory at once.
+        """
+        with self._lock:
+            ids = [row[0] for row in self._db.execute("SELECT id FROM comics ORDER BY position")]
+
+        for id in ids:
+            comic = self.get_by_id(id)
+            if comic is not None:
+                yield comic
+
+    def _to_comic(self, row) -> Comic:
+        id, name, slug, status, created_at, updated_at, covers, volume_breakpoints, paywalled = row
+        comic = Comic(name=name, id=id, slug=slug, status=ComicStatus[status], created_at=created_at,
+                      updated_at=updated_at, covers=json.loads(covers))
+        comic.volume_breakpoints = json.loads(volume_breakpoints) or {"chapter-1": "01"}
+        comic.paywalled = json.loads(paywalled)
+
+        chapters = self._db.execute("""
+            SELECT position, id, name, slug, thumbnail_url, created_at FROM chapters
+            WHERE comic_id = ? ORDER BY position
+        """, (id,)).fetchall()
+        pages = self._db.execute("""
+            SELECT chapter_position, url FROM pages WHERE comic_id = ? ORDER BY chapter_position, position
+        """, (id,)).fetchall()
+
+        page_lists = {}
+        for chapter_position, url in pages:
+            page_lists.setdefault(chapter_position, []).append(url)
+
+        comic_chapters = []
+        for position, chapter_id, chapter_name, chapter_slug, thumbnail_url, chapter_created_at in chapters:
+            chapter = Chapter(name=chapter_name, id=chapter_id, slug=chapter_slug, thumbnail_url=thumbnail_url,
+                              created_at=chapter_created_at)
+            # The slug is stored after the epilogue rename done by Chapter
+            chapter.slug = chapter_slug
+            chapter.pages = page_lists.get(position, [])
+            comic_chapters.append(chapter)
+
+        comic.chapters = comic_chapters
+        return comic
+
+    def _query(self, where:str="", params:tuple=(), limit:int=-1, order:str="position") -> list[Comic]:
+        with self._lock:
+            rows = self._db.execute(f"""
+                SELECT id, name, slug, status, created_at, updated_at, covers, volume_breakpoints, paywalled
+                FROM comics {where} ORDER BY {order} LIMIT ?
+            """, (*params, limit)).fetchall()
+            return [self._to_comic(row) for row in rows]
+
+    def load_all(self) -> list[Comic]:
+        return self._query()
+
+    def get_by_id(self, id) -> Comic:
+        comics = self._query("WHERE id = ?", (id,), limit=1)
+        return comics[0] if comics else None
+
+    def get_by_slug(self, slug:str) -> Comic:
+        comics = self._query("WHERE slug = ?", (slug,), limit=1)
+        return comics[0] if comics else None
+
+    def titles(self):
+        with self._lock:
+            return self._db.execute("SELECT id, name, slug FROM comics ORDER BY position").fetchall()
+
+    def search(self, query:str, limit:int=10, status:ComicStatus=None) -> list[Comic]:
+        """
+        Returns up to limit comics best matching the query, see TitleIndex. 
+        Only comics with the given status are returned, if any.
+        """
+        if self.title_index is None:
+            self.title_index = load_title_index(self.title_index_path, self.sync_time, self.titles)
+
+        accept = None
+        if status is not None:
+            with self._lock:
+                accept = {row[0] for row in self._db.execute("SELECT id FROM comics WHERE status = ?", 
+                                                             (status.name,))}.__contains__
+        return [self.get_by_id(id) for id in self.title_index.search(query, limit, accept)]
+
+    def find_by_name(self, query:str, status:ComicStatus=None) -> Comic:
+        """
+        Returns the comic named query, ignoring case, or else the comic with the
+        shortest name starting with it. Both are looked up through the name 
+        index. Falls back to the best match of search() if neither exists. Only
+        comics with the given status are returned, if any.
+        """
+        where, params = "", ()
+        if status is not None:
+            where, params = " AND status = ?", (status.name,)
+
+        query = query.strip()
+        if query:
+            comics = self._query("WHERE name = ? COLLATE NOCASE" + where, (query, *params), limit=1)
+            if not comics:
+                pattern = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                comics = self._query("WHERE name LIKE ? ESCAPE '\\'" + where, (pattern, *params), limit=1, 
+                                     order="length(name), position")
+            if comics:
+                return comics[0]
+
+        comics = self.search(query, 1, status)
+        return comics[0] if comics else None
+
+    def with_status(self, status:ComicStatus) -> list[Comic]:
+        return self._query("WHERE status = ?", (status.name,))
+
+    def _write_comic(self, position:int, comic:Comic, chapters:bool):
+        self._db.execute("""
+            INSERT INTO comics (id, position, name, slug, status, created_at, updated_at, covers, 
+                                volume_breakpoints, paywalled)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET
+            position = excluded.position, name = excluded.name, slug = excluded.slug,
+            status = excluded.status, created_at = excluded.created_at, updated_at = excluded.updated_at,
+            covers = excluded.covers, volume_breakpoints = excluded.volume_breakpoints, 
+            paywalled = excluded.paywalled
+        """, (comic.id, position, comic.name, comic.slug, comic.status.name, comic.created_at, comic.updated_at,
+              json.dumps(comic.covers), json.dumps(comic.volume_breakpoints), json.dumps(comic.paywalled)))
+
+        if not chapters:
+            return
+
+        self._db.execute("DELETE FROM chapters WHERE comic_id = ?", (comic.id,))
+        self._db.executemany("INSERT INTO chapters VALUES (?, ?, ?, ?, ?, ?, ?)", [
+            (chapter.id, comic.id, i, chapter.name, chapter.slug, chapter.thumbnail_url, chapter.created_at)
+            for i, chapter in enumerate(comic.chapters)
+        ])
+        self._db.executemany("INSERT INTO pages VALUES (?, ?, ?, ?)", [
+            (comic.id, i, j, url) for i, chapter in enumerate(comic.chapters) for j, url in enumerate(chapter.pages)
+        ])
+
+    def upsert(self, comic_list, updated:set=None, fetched:str=None, watermark:str=None) -> int:
+        """
+        Writes the catalog in a single transaction and returns the number of 
+        comics written. comic_list can be any iterable of comics, comics missing
+        from it are removed. Chapters and pages are only rewritten for comics 
+        whose id is in updated, or for every comic if updated is None. fetched
+        is stored as the sync time, the current time if None, along with the
+        watermark, the latest updated_at of the comics if None.
+        """
+        with self._lock, self._db:
+            self._db.execute("CREATE TEMP TABLE IF NOT EXISTS keep (id INTEGER PRIMARY KEY)")
+            self._db.execute("DELETE FROM keep")
+
+            count = 0
+            for position, comic in enumerate(comic_list):
+                self._db.execute("INSERT OR IGNORE INTO keep VALUES (?)", (comic.id,))
+                self._write_comic(position, comic, chapters=updated is None or comic.id in updated)
+                count += 1
+
+            self._db.execute("DELETE FROM comics WHERE id NOT IN (SELECT id FROM keep)")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('fetched', ?)", (fetched or str(datetime.now()),))
+            if watermark is None:
+                self._db.execute("INSERT OR REPLACE INTO meta SELECT 'watermark', MAX(updated_at) FROM comics")
+            else:
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('watermark', ?)", (watermark,))
+            self.title_index = None
+
+        return count
@@ -0,0 +1,206 @@
+import json
+import os
+from functools import partial
+from pathlib import Path
+
+from omegadl.objects import Comic, Chapter, ComicStatus, dict_to_comic, dict_to_chapter
+from omegadl.search import TitleIndex, load_title_index
+
+
+# catalog.json is written one comic at a time so that the byte range of every
+# comic, and of its chapters, is known. These ranges are kept in a sidecar index
+# along with the size and modification time of catalog.json they belong to. A
+# comic can then be read without parsing the rest of the catalog, and its
+# chapters only once they are accessed.
+
+
+def write_catalog(catalog_path:Path, index_path:Path, comic_list, fetched:str, watermark:str=None):
+    """
+    Writes the catalog as json along with its offset index. comic_list can be
+    any iterable of comics. Both files are written under a temporary name and
+    then moved in place, so that readers never see a partly written catalog.
+    Comics whose chapters are deferred to the previous catalog can load them
+    while it is being written, but not once it has been replaced. The watermark
+    is the latest updated_at of the comics unless given.
+    """
+    partial_path = catalog_path.with_name(f"{catalog_path.name}.part")
+    entries = []
+    latest = None
+
+    with open(partial_path, "wb") as f:
+        f.write(b'{"data": [')
+
+        for i, comic in enumerate(comic_list):
+            if i > 0:
+                f.write(b", ")
+
+            encoded = comic.encode()
+            chapters = json.dumps(encoded.pop("chapters"), default=vars).encode()
+            # The metadata is written first and the chapters last, so that the
+            # metadata can be parsed on its own.
+            metadata = json.dumps(encoded, default=vars).encode()[:-1]
+
+            offset = f.tell()
+            f.write(metadata + b', "chapters": ' + chapters + b"}")
+
+            entries.append({
+                "id": comic.id,
+                "slug": comic.slug,
+                "name": comic.name,
+                "status": comic.status.name,
+                "offset": offset,
+                "length": len(metadata),
+                "chapters_offset": offset + len(metadata) + len(b', "chapters": '),
+                "chapters_length": len(chapters),
+            })
+            if comic.updated_at is not None and (latest is None or comic.updated_at > latest):
+                latest = comic.updated_at
+
+        if watermark is None:
+            watermark = latest
+
+        # The metadata goes last, the watermark is only known once every comic
+        # has been written.
+        f.write(b'], "meta": ' + json.dumps({"fetched": fetched, "watermark": watermark}).encode() + b"}")
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(partial_path, catalog_path)
+    stat = os.stat(catalog_path)
+
+    partial_path = index_path.with_name(f"{index_path.name}.part")
+    with open(partial_path, "w") as f:
+        f.write(json.dumps({
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "fetched": fetched,
+            "watermark": watermark,
+            "comics": entries,
+        }))
+    os.replace(partial_path, index_path)
+
+
+def read_index(catalog_path:Path, index_path:Path) -> dict:
+    """
+    Returns the offset index of catalog.json, or None if there is none or it
+    was written for a different version of the file.
+    """
+    try:
+        stat = os.stat(catalog_path)
+        with open(index_path, "r") as f:
+            index = json.loads(f.read())
+    except (OSError, json.JSONDecodeError):
+        return None
+
+    if index.get("size") != stat.st_size or index.get("mtime") != stat.st_mtime_ns:
+        return None
+    return index
+
+
+def _check_version(f, catalog_path:Path, size:int, mtime:int):
+    # The file is checked through the open handle, so that it cannot be replaced
+    # between the check and the read.
+    stat = os.fstat(f.fileno())
+    if stat.st_size != size or stat.st_mtime_ns != mtime:
+        raise RuntimeError(f"{catalog_path} was replaced after it was indexed, load the catalog again.")
+
+
+def _read_range(catalog_path:Path, offset:int, length:int, size:int, mtime:int) -> bytes:
+    with open(catalog_path, "rb") as f:
+        _check_version(f, catalog_path, size, mtime)
+        f.seek(offset)
+        return f.read(length)
+
+
+def read_chapters(catalog_path:Path, offset:int, length:int, size:int, mtime:int) -> list[Chapter]:
+    """
+    Parses the chapters of a single comic from catalog.json. Raises RuntimeError
+    if catalog.json is no longer the version of the given size and modification
+    time the offsets were taken from.
+    """
+    return [dict_to_chapter(chapter) for chapter in json.loads(_read_range(catalog_path, offset, length, size, mtime))]
+
+
+class IndexedCatalog:
+    """
+    Read only view of catalog.json through its offset index. Lookups by id,
+    slug, name and status are answered from the index and only the matching
+    comics are parsed. Their chapters are parsed on first access.
+    """
+
+    def __init__(self, catalog_path:Path, index:dict, title_index_path:Path=None):
+        self.catalog_path = catalog_path
+        self.title_index_path = title_index_path
+        self.title_index: TitleIndex = None
+        self.sync_time = index["fetched"]
+        self.watermark = index.get("watermark")
+        self._version = (index["size"], index["mtime"])
+        self._entries = index["comics"]
+        self._by_id = {entry["id"]: entry for entry in self._entries}
+        self._by_slug = {entry["slug"]: entry for entry in self._entries}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self):
+        """
+        Yields every comic with lazily loaded chapters. Comics are parsed as they
+        are reached, so a comic dropped by the caller is not kept in memory.
+        """
+        for entry in self._entries:
+            yield self._load(entry)
+
+    def iter_comics(self):
+        """
+        Yields every comic with its chapters, reading catalog.json front to back
+        through a single file handle.
+        """
+        with open(self.catalog_path, "rb") as f:
+            _check_version(f, self.catalog_path, *self._version)
+            for entry in self._entries:
+                f.seek(entry["offset"])
+                comic = dict_to_comic(json.loads(f.read(entry["length"]) + b"}"))
+                f.seek(entry["chapters_offset"])
+                comic.chapters = [dict_to_chapter(chapter) for chapter in json.loads(f.read(entry["chapters_length"]))]
+                yield comic
+
+    def _load(self, entry:dict) -> Comic:
+        comic = dict_to_comic(json.loads(_read_range(self.catalog_path, entry["offset"], entry["length"], 
+                                                     *self._version) + b"}"))
+        # A partial of a module level function, so that comics can still be
+        # pickled for the packaging processes. The version of catalog.json goes
+        # along, as the offsets are meaningless in any other one.
+        comic.defer_chapters(partial(read_chapters, self.catalog_path, entry["chapters_offset"],
+                                     entry["chapters_length"], *self._version))
+        return comic
+
+    def load_all(self) -> list[Comic]:
+        return list(self)
+
+    def get_by_id(self, id) -> Comic:
+        entry = self._by_id.get(id)
+        return self._load(entry) if entry is not None else None
+
+    def get_by_slug(self, slug:str) -> Comic:
+        entry = self._by_slug.get(slug)
+        return self._load(entry) if entry is not None else None
+
+    def titles(self):
+        return [(entry["id"], entry["name"], entry["slug"]) for entry in self._entries]
+
+    def search(self, query:str, limit:int=10, status:ComicStatus=None) -> list[Comic]:
+        """
+        Returns up to limit comics best matching the query, see TitleIndex. 
+        Only comics with the given status are returned, if any.
+        """
+        if self.title_index is None:
+            self.title_index = load_title_index(self.title_index_path, self.sync_time, self.titles)
+        accept = (lambda id: self._by_id[id]["status"] == status.name) if status is not None else None
+        return [self.get_by_id(id) for id in self.title_index.search(query, limit, accept)]
+
+    def find_by_name(self, query:str, status:ComicStatus=None) -> Comic:
+        comics = self.search(query, 1, status)
+        return comics[0] if comics else None
+
+    def with_status(self, status:ComicStatus) -> list[Comic]:
+        return [self._load(entry) for entry in self._entries if entry["status"] == status.name]
@@ -0,0 +1,45 @@
+from collections import namedtuple
+
+from omegadl.objects import Chapter
+
+
+ChapterDiff = namedtuple("ChapterDiff", ["added", "removed", "retained"])
+# added: Remote chapters missing from the local list, in remote order
+# removed: Local chapters no longer listed remotely, in local order
+# retained: Local chapters still listed remotely, in remote order
+
+
+def diff_chapters(local:list[Chapter], remote:list[Chapter]) -> ChapterDiff:
+    """
+    Compares the local and remote chapter lists of a comic by chapter id in a
+    single pass over each.
+    """
+    local_by_id = {chapter.id: chapter for chapter in local}
+    remote_ids = set()
+
+    added = []
+    retained = []
+    for chapter in remote:
+        remote_ids.add(chapter.id)
+        local_chapter = local_by_id.get(chapter.id)
+        if local_chapter is None:
+            added.append(chapter)
+        else:
+            retained.append(local_chapter)
+
+    removed = [chapter for chapter in local if chapter.id not in remote_ids]
+
+    return ChapterDiff(added, removed, retained)
+
+
+def merge_chapters(remote:list[Chapter], diff:ChapterDiff, skipped:set=frozenset()) -> list[Chapter]:
+    """
+    Returns the chapters of a diff in remote order. Retained chapters are the
+    local objects, so the pages they already hold are kept. Chapters whose id
+    is in skipped are left out.
+    """
+    chapters_by_id = {chapter.id: chapter for chapter in diff.added}
+    chapters_by_id.update((chapter.id, chapter) for chapter in diff.retained)
+
+    return [chapters_by_id[chapter.id] for chapter in remote
+            if chapter.id in chapters_by_id and chapter.id not in skipped]
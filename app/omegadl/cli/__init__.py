@@ -3,14 +3,18 @@ from pathlib import Path
 import os
 import shutil
 import logging
+import queue
+import threading
 
 from rich.logging import RichHandler
 from rich.console import Console
+from rich.progress import Progress
 
 from omegadl.objects import Config, Chapter
 from omegadl.cli.catalog import catalog, update_catalog
 from omegadl.cli.comics import comics, download_missing_chapters
-from omegadl.catalog import load_catalog
+from omegadl.catalog import open_catalog, search_comics
+from omegadl import transport, cache
 
 
 FORMAT = "%(message)s"
@@ -35,7 +39,8 @@ def set_verbose(level):
 @click.option("--library", help="Set the directory for saving comics.")
 @click.option("--output", default="./", help="Set the output directory for omegadl. This is where the cache and catalog files are stored.")
 @click.option("--disable-cache", help="Disable request cachine. This will make omegadl always fetch from the server.", is_flag=True)
-def cli(ctx, output, disable_cache:bool, library):
+@click.option("--revalidate", help="Revalidate cached listings with the server instead of trusting them until they expire.", is_flag=True)
+def cli(ctx, output, disable_cache:bool, library, revalidate:bool):
     ctx.ensure_object(dict)
 
     if not output.endswith("mdlout"):
@@ -55,6 +60,12 @@ def cli(ctx, output, disable_cache:bool, library):
     if library is not None:
         config.library_path = Path(library)
 
+    if revalidate:
+        config.cache_revalidate = True
+
+    transport.configure(config)
+    cache.configure(config)
+
     ctx.obj['config'] = config
 
 
@@ -71,21 +82,54 @@ def reset_config(ctx):
 
 
 # Add an option "full delete" that deletes logos and other static files
-# Prevent deletion of covers and logos.
 @cli.command()
 @click.pass_context
-def clear_cache(ctx):
+@click.option("--endpoint", type=click.Choice(cache.ENDPOINTS), help="Only clear responses of this api endpoint.")
+@click.option("--comic", help="Only clear responses of comics matching this search query.")
+@click.option("--older-than", type=float, help="Only clear responses older than this many days.")
+def clear_cache(ctx, endpoint, comic, older_than):
     """
     Clears the requests cache stored in mdlout/cache directory.
     """
-    cache_dir = ctx.obj["config"].output_path / "cache"
+    config:Config = ctx.obj["config"]
+    cache_dir = config.output_path / "cache"
 
     if not os.path.exists(cache_dir):
         log.error("Cache directory does not exist in the given location.")
         return
-    
-    shutil.rmtree(cache_dir)
-    log.info("Cleared omegadl cache.")
+
+    comics = None
+    if comic is not None:
+        catalog = open_catalog(config.output_path, config.catalog_backend)
+        comics = []
+        for _comic in search_comics(catalog, comic):
+            if _comic is not None:
+                comics.extend([_comic.id, _comic.slug])
+
+    if older_than is not None:
+        older_than = older_than * 24 * 60 * 60
+
+    removed = cache.get_cache(config.output_path).purge(endpoint=endpoint, comics=comics, older_than=older_than)
+
+    # Remove the cache layout used by older versions of omegadl.
+    if endpoint is None and comic is None and older_than is None and os.path.exists(cache_dir / "requests"):
+        shutil.rmtree(cache_dir / "requests")
+
+    log.info(f"Cleared {removed} cached responses.")
+
+
+@cli.command(name="cache-info")
+@click.pass_context
+def show_cache_info(ctx):
+    """
+    Prints the size and hit/miss counters of the requests cache.
+    """
+    config:Config = ctx.obj["config"]
+    stats = cache.get_cache(config.output_path).stats()
+
+    for endpoint, values in stats.items():
+        click.echo(f"{endpoint}: {values['entries']} entries, {values['bytes']/1024/1024:.1f} MB, "
+                   f"{values['hits']} hits, {values['misses']} misses")
 
 
 @cli.command(name="version")
@@ -100,60 +144,91 @@ def display_version():
 
 @cli.command(name="pull")
 @click.option("--y", help="Automatically accept the list of downloads and start downloading", is_flag=True)
+@click.option("--budget", type=int, help="Download up to this many MB without asking while the catalog is updated. Defaults to pull_budget_mb in the config.")
 @click.pass_context
-def fetch_subscribed_comics(ctx, y:bool=False):
+def fetch_subscribed_comics(ctx, y:bool=False, budget:int=None):
     """
     Update the catalog for all titles in the subscribed list present in the 
-    config file and then download only the missing chapters from those comics.
+    config file and download only the missing chapters from those comics. Each
+    comic is downloaded as soon as it is up to date, while the rest are still 
+    being updated.
+
+    Unless --y is given, comics are only downloaded right away while the total
+    estimated size stays within the budget (100 MB unless configured). The rest
+    are listed for confirmation once the update is done. With --budget=0 nothing
+    is downloaded while the catalog is being updated.
 
     Add/Remove comic(s) from subscription list using `omegadl comics "query" add/remove`
     """
 
     config:Config = ctx.obj["config"]
+    if budget is None:
+        budget = config.pull_budget_mb
 
-    # Update catalog
-    catalog = update_catalog(config=config, filter_list=config.subscription_list)
+    updated_comics = queue.Queue()
+    deferred = [] # (comic, missing chapters, size in MB) asked for at the end
+    accepted = 0
+    downloaded = 0
 
+    def download_updated_comics(progress:Progress):
+        nonlocal accepted, downloaded
+
+        while True:
+            comic = updated_comics.get()
+            if comic is None:
+                return
+
+            _chapter_list = [chapter for chapter in comic.chapters 
+                             if not chapter.is_downloaded(comic, config.library_path)]
+            if not _chapter_list:
+                continue
 
-    # Download missing chapters.
-    download_queue:list[Chapter] = []
-    _size = 0
-    for comic in catalog:
-        if comic.id not in config.subscription_list:
-            continue
-        
-        to_download = False
-        _chapter_list = []
-        for chapter in comic.chapters:
-            if not chapter.is_downloaded(comic, config.library_path):
-                _chapter_list.append(chapter)
-                to_download = True
-        
-        if _chapter_list:
             size = sum([len(x.pages) for x in _chapter_list])*4
-            _size += size
-            print("\n", comic.name[:45], f"({size}) MB" )
-            for __chapter in _chapter_list:
-                print(__chapter.name)
-        
-        if to_download and comic not in download_queue:
-            download_queue.append(comic)
-    
-    if len(download_queue) == 0:
-        print("Nothing to download. Library is up-to-date.")
+            if not y and accepted + size > budget:
+                deferred.append((comic, _chapter_list, size))
+                continue
+
+            accepted += size
+            log.info(f"Downloading {len(_chapter_list)} chapter(s) of {comic.name[:45]} ({size} MB)")
+            try:
+                download_missing_chapters(config, comic, progress)
+                downloaded += 1
+            except Exception as e:
+                log.error(f"Could not download '{comic.name}': {e}")
+
+    # Update catalog, handing every comic over to the downloader as soon as it 
+    # is up to date.
+    with Progress() as progress:
+        downloader = threading.Thread(target=download_updated_comics, args=(progress,), daemon=True)
+        downloader.start()
+        try:
+            update_catalog(config=config, filter_list=config.subscription_list or [], progress=progress,
+                           on_updated=updated_comics.put)
+        finally:
+            updated_comics.put(None)
+            downloader.join()
+
+    if not deferred:
+        if downloaded == 0:
+            print("Nothing to download. Library is up-to-date.")
+        return
+
+    _size = 0
+    for comic, _chapter_list, size in deferred:
+        _size += size
+        print("\n", comic.name[:45], f"({size}) MB" )
+        for __chapter in _chapter_list:
+            print(__chapter.name)
+
+    print(f"This operation may take as much as {_size} MBs of storage.")
+    _inp = input("Would you like to proceed (y/n): ")
+    if _inp != "y":
         return
     
-    if not y:
-        print(f"This operation may take as much as {_size} MBs of storage.")
-        _inp = input("Would you like to proceed (y/n): ")
-        if _inp != "y":
-            return
-    
-    for comic in download_queue:
+    for comic, _, _ in deferred:
         download_missing_chapters(config, comic)
     
     
-    
 
 cli.add_command(catalog)
 cli.add_command(comics)
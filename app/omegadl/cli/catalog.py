@@ -1,13 +1,17 @@
 import click
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
 
 from rich.logging import RichHandler
 from rich.console import Console
 from rich.progress import Progress
 
-from omegadl.catalog import load_catalog, dump_catalog, get_comic_by_id
-from omegadl.fetch import get_comic_list, get_chapters, update_comic_metadata
+from omegadl.catalog import (Catalog, load_catalog, dump_catalog, append_to_journal, load_journal, clear_journal,
+                             get_catalog_path, migrate_catalog)
+from omegadl.fetch import get_comic_list, get_updated_comic_list, get_chapters, update_comic_metadata
 from omegadl.objects import Comic, ComicStatus, Config
 
 FORMAT = "%(message)s"
@@ -34,8 +38,8 @@ def show_catalog_info(ctx):
     """
     config:Config = ctx.obj['config']
 
-    log.info(f"Loading catalog from {config.output_path}/catalog.json")
-    catalog, sync_time = load_catalog(output_dir=config.output_path)
+    log.info(f"Loading catalog from {get_catalog_path(config.output_path, config.catalog_backend)}")
+    catalog, sync_time = load_catalog(output_dir=config.output_path, backend=config.catalog_backend)
 
     click.echo(f"Catalog last synced at: {sync_time}")
     click.echo(f"Indexed {len(catalog)} titles.")
@@ -45,7 +49,8 @@ def show_catalog_info(ctx):
 @catalog.command(name="generate")
 @click.pass_context
 @click.option("--disable-overwrite", help="Do not generate a new catalog if it already exists.", is_flag=True)
-def generate_catalog(ctx, disable_overwrite:bool):
+@click.option("--resume", help="Resume an interrupted catalog generation, skipping comics that were already fetched.", is_flag=True)
+def generate_catalog(ctx, disable_overwrite:bool, resume:bool=False):
     """
     Generates a fresh comic catalog.
     """
@@ -54,62 +59,152 @@ def generate_catalog(ctx, disable_overwrite:bool):
     if disable_overwrite is not None:
         config.overwrite_catalog = not(disable_overwrite)
 
-    catalog_path = config.output_path / "catalog.json"
+    catalog_path = get_catalog_path(config.output_path, config.catalog_backend)
 
-    if config.overwrite_catalog == False and os.path.exists(catalog_path):
+    if config.overwrite_catalog == False and os.path.exists(catalog_path) and not resume:
         log.info("Catalog already generated, skipping overwrite...")
         return
 
     with console.status("[bold green]Fetching comic list...") as status:
-        comic_list = get_comic_list(output_dir=config.output_path)
+        comic_list = get_comic_list(output_dir=config.output_path, cache=config.cache, workers=config.fetch_workers)
         log.info(f"Fetched {len(comic_list)} comic titles")
 
-    comics = []
-    with Progress() as progress:
-        fetch_comics_task = progress.add_task("[red]Downloading Comics Data...", total=len(comic_list))
-
-        for i,comic in enumerate(comic_list):
-            progress.update(fetch_comics_task, description=f"[red][{i+1}/{len(comic_list)}] Downloading {comic.name}...")
-            comic.chapters = get_chapters(config.output_path, comic, update=False)
+    # Every completed comic is appended to a journal, which is compacted into
+    # the catalog once all comics are done.
+    completed = Catalog()
+    if resume:
+        completed = Catalog(load_journal(config.output_path))
+        log.info(f"Resuming catalog generation with {len(completed)} comics already fetched")
+    else:
+        clear_journal(config.output_path)
+
+    pending = [comic for comic in comic_list if comic.id not in completed]
+
+    # Comics are processed concurrently. Their chapter page lookups all go through
+    # the shared page executor, which caps the number of in-flight requests.
+    with Progress() as progress, ThreadPoolExecutor(max_workers=config.fetch_workers) as executor:
+        fetch_comics_task = progress.add_task("[red]Downloading Comics Data...", total=len(comic_list),
+                                              completed=len(comic_list) - len(pending))
+
+        futures = {executor.submit(get_chapters, config.output_path, comic, False, config.cache, 
+                                   config.fetch_workers): comic for comic in pending}
+        failed = 0
+        for i,future in enumerate(as_completed(futures)):
+            comic = futures[future]
+            progress.update(fetch_comics_task, description=f"[red][{i+1}/{len(pending)}] Downloaded {comic.name}...")
+            try:
+                comic.chapters = future.result()
+            except Exception as e:
+                log.error(f"Could not fetch '{comic.name}': {e}")
+                failed += 1
+                continue
             if comic.volume_breakpoints == {}:
                 comic.volume_breakpoints = {comic.chapters[-1].slug: "1"}
-            comics.append(comic)
+            append_to_journal(config.output_path, comic)
+            completed.insert(comic)
             progress.update(fetch_comics_task, advance=1)
-            dump_catalog(config.output_path, comics)      
+
+    if failed:
+        log.error(f"{failed} comic(s) could not be fetched. Run `catalog generate --resume` to retry them.")
+        return
+
+    # Keep the order of the remote listing
+    dump_catalog(config.output_path, [completed.get_by_id(comic.id) for comic in comic_list if comic.id in completed],
+                 config.catalog_backend)
+    clear_journal(config.output_path)
     
 
+@catalog.command(name="migrate")
+@click.pass_context
+def migrate_catalog_command(ctx):
+    """
+    Moves the catalog from catalog.json to the sqlite backend (catalog.db).
+    """
+    config:Config = ctx.obj["config"]
+    catalog_path = get_catalog_path(config.output_path, "json")
+
+    if not os.path.exists(catalog_path):
+        log.error(f"Catalog cannot be found at {catalog_path}. Exiting...")
+        return
+
+    with console.status("[bold green]Migrating catalog...") as status:
+        migrated = migrate_catalog(config.output_path)
+
+    log.info(f"Migrated {migrated} comics to {get_catalog_path(config.output_path, 'sqlite')}. "
+             f"catalog.json was kept and can be removed.")
+
+    config.catalog_backend = "sqlite"
+    config.save()
+
+
 @catalog.command(name="update")
 @click.pass_context
 @click.option("--generate", help="Generate a new config if it does not exist", is_flag=True)
-def update_catalog_command(ctx, generate):
+@click.option("--full", help="List every comic and check the ones that were not updated as well.", is_flag=True)
+def update_catalog_command(ctx, generate, full):
     """
     Selectively updates parts of the comic catalog if it already exists.
     """
     
     config:Config = ctx.obj["config"]
-    catalog_path = config.output_path / "catalog.json"
+    catalog_path = get_catalog_path(config.output_path, config.catalog_backend)
 
     if not os.path.exists(catalog_path):
         if generate:
-            generate_catalog(ctx)
+            ctx.invoke(generate_catalog, disable_overwrite=False)
         else:
             log.error(f"Catalog cannot be found at {catalog_path}. Exiting...")
         return
     
-    update_catalog(config)
+    update_catalog(config, full=full)
 
 
 
-def update_catalog(config:Config, filter_list:list[int]=None) -> list[Comic]:
+@contextmanager
+def _status(message:str, progress:Progress=None):
+    """
+    Shows a status spinner, or a task without a total on progress if the caller
+    already has a live progress display, since only one can be shown at once.
+    """
+    if progress is None:
+        with console.status(message) as status:
+            yield status
+        return
+
+    task = progress.add_task(message, total=None)
+    try:
+        yield None
+    finally:
+        progress.remove_task(task)
+
+
+def update_catalog(config:Config, filter_list:list[int]=None, full:bool=False, progress:Progress=None,
+                   on_updated=None) -> Catalog:
     # filter_list is a list of comic IDs that you can use to selectively update comics.
     # Mainly used for quick updating subscription list titles. Leave none to include all.    
-    origin_catalog,_ = load_catalog(config.output_path)
-
-    with console.status("[bold green]Fetching comic list...") as status:
-        remote_catalog = get_comic_list(output_dir=config.output_path, cache=config.cache)
-        log.info(f"Fetched {len(remote_catalog)} comic titles")
+    # Unless full is set, only the comics updated since the watermark of the catalog are
+    # listed, and comics whose updated_at did not change are left as they are.
+    # progress is a live progress display to show the update on instead of a new one.
+    # on_updated is called with every comic in filter_list once it is up to date, so
+    # that it can be downloaded while the rest are still being updated.
+    origin_catalog, sync_time = load_catalog(config.output_path, config.catalog_backend)
+    watermark = None if full else origin_catalog.watermark
+    # Cached chapter lists are only trusted to match the catalog if they were 
+    # stored before it was last saved.
+    synced_at = datetime.fromisoformat(sync_time).timestamp() if sync_time is not None else None
+
+    with _status("[bold green]Fetching comic list...", progress) as status:
+        remote_catalog, complete = get_updated_comic_list(output_dir=config.output_path, cache=config.cache, 
+                                                          watermark=watermark, workers=config.fetch_workers)
+        if complete:
+            log.info(f"Fetched {len(remote_catalog)} comic titles")
+        else:
+            log.info(f"Fetched {len(remote_catalog)} comic titles updated since {watermark}")
     
-        updated_catalog_list = []
+        # Comics are kept in the order of the remote listing. A partial listing only
+        # has the updated comics, so the rest are kept from the local catalog in their
+        # current order, and the listed ones replace them in place.
+        updated_catalog = Catalog() if complete else Catalog(origin_catalog)
         process_queue = [] 
         # Contains (Comic, bool) pair where bool tells if the comic needs to be updated or not.
         # If the bool is false, then all chapters will be fetched, if it is true then only selected chapters
@@ -117,16 +212,22 @@ def update_catalog(config:Config, filter_list:list[int]=None) -> list[Comic]:
 
 
         # Compare Titles and Update
-    with console.status("[bold green]Comparing local and remote catalog...") as status:
+    with _status("[bold green]Comparing local and remote catalog...", progress) as status:
         for remote_comic in remote_catalog:
-            local_comic = get_comic_by_id(origin_catalog, remote_comic.id)
+            local_comic = origin_catalog.get_by_id(remote_comic.id)
                 
             if local_comic is None:
                 log.debug(f"{remote_comic.name} not present in local catalog. Adding to fetch list.")
+                updated_catalog.insert(remote_comic)
                 process_queue.append((remote_comic, False))
                 continue
 
+            if not full and local_comic.updated_at == remote_comic.updated_at:
+                updated_catalog.insert(local_comic)
+                continue
+
             local_comic:Comic = update_comic_metadata(local_comic, remote_comic)
+            updated_catalog.insert(local_comic)
 
             if local_comic.status == ComicStatus.ONGOING and remote_comic.status == ComicStatus.ONGOING:
                 process_queue.append((local_comic, True))
@@ -139,39 +240,55 @@ def update_catalog(config:Config, filter_list:list[int]=None) -> list[Comic]:
                 log.debug(f"Adding {local_comic.name} to fetch list. Local status hiatus but remote status not hiatus")
                 process_queue.append((local_comic, True))
 
-            else:
-                # If the comic doesn't need to be updated
-                updated_catalog_list.append(local_comic)
-
     print(len(process_queue))
-    non_sub_list: list[Comic] = []
     
     # Remove comics from process_queue if not in filter_list (if specified)
+    new_watermark = None
     if filter_list is not None:
-        for i in process_queue:
-            _comic = i[0]
-            if _comic.id not in filter_list:
-                non_sub_list.append(i)
-
-        for i in non_sub_list:
-            process_queue.remove(i)
-            updated_catalog_list.append(i[0])
-
-    with Progress() as progress:
+        filter_list = set(filter_list)
+        left_out = [comic for comic, _ in process_queue if comic.id not in filter_list]
+        process_queue = [(comic, update) for comic, update in process_queue if comic.id in filter_list]
+
+        # Comics left out keep their local updated_at, so that they still count
+        # as changed on the next sync, and the watermark stays low enough for the
+        # next listing to reach them again.
+        for comic in left_out:
+            if new_watermark is None or comic.updated_at < new_watermark:
+                new_watermark = comic.updated_at
+            local_comic = origin_catalog.get_by_id(comic.id)
+            comic.updated_at = local_comic.updated_at if local_comic is not None else None
+
+    # Comics that are not fetched again are already up to date.
+    if on_updated is not None:
+        queued = {comic.id for comic,_ in process_queue}
+        for comic in updated_catalog:
+            if comic.id not in queued and (filter_list is None or comic.id in filter_list):
+                on_updated(comic)
+
+    shared_progress = progress is not None
+    with (nullcontext(progress) if shared_progress else Progress()) as progress, \
+            ThreadPoolExecutor(max_workers=config.fetch_workers) as executor:
         update_comics_task = progress.add_task("[red]Downloading Comics...", total=len(process_queue))
 
-        for i in process_queue:
-            comic = i[0]
-            progress.update(update_comics_task, description=f"[red]Updating {comic.name}...")
-            comic.chapters = get_chapters(config.output_path, comic, update=i[1], cache=config.cache)
+        futures = {executor.submit(get_chapters, config.output_path, comic, update, config.cache, 
+                                   config.fetch_workers, synced_at): comic for comic, update in process_queue}
+        for future in as_completed(futures):
+            comic = futures[future]
+            progress.update(update_comics_task, description=f"[red]Updated {comic.name}...")
+            comic.chapters = future.result()
             if comic.volume_breakpoints == {}:
                 comic.volume_breakpoints = {comic.chapters[-1].slug: "1"}
-            updated_catalog_list.append(comic)
+            updated_catalog.replace(comic)
             log.info(f"Updated '{comic.name}' in catalog.")
             progress.update(update_comics_task, advance=1)
+            if on_updated is not None:
+                on_updated(comic)
+        if shared_progress:
+            progress.remove_task(update_comics_task)
 
-    dump_catalog(config.output_path, updated_catalog_list)
-
-    return updated_catalog_list
-
+    # Only the chapters of the processed comics changed, the rest only had their
+    # metadata updated.
+    dump_catalog(config.output_path, updated_catalog, config.catalog_backend,
+                 updated={comic.id for comic,_ in process_queue}, watermark=new_watermark)
 
+    return updated_catalog
@@ -1,7 +1,7 @@
 import json
 import click
-import shutil
 import logging
+from contextlib import nullcontext
 
 from rich.progress import Progress
 from rich.table import Table
@@ -9,9 +9,10 @@ from rich.logging import RichHandler
 from rich.syntax import Syntax
 from rich.console import Console
 
-from omegadl.catalog import load_catalog, search_comics
+from omegadl.catalog import open_catalog, search_comics
 from omegadl.objects import Comic, Config
 from omegadl.downloader import download_chapter
+from omegadl.packager import PackagingStage
 
 FORMAT = "%(message)s"
 logging.basicConfig(
@@ -65,7 +66,8 @@ def display_comics_as_table(catalog:list[Comic], config:Config):
 
 @comics.command(name="list")
 @click.pass_context
-def list_comics(ctx):
+@click.option("--limit", default=10, help="Number of best matching titles to show for each title query.")
+def list_comics(ctx, limit:int):
     """
     Search for comics. You can search via comic id or comic name.
     """
@@ -73,9 +75,9 @@ def list_comics(ctx):
     config:Config = ctx.obj["config"]
     query = ctx.obj["query"]
 
-    catalog,_ = load_catalog(config.output_path)
+    catalog = open_catalog(config.output_path, config.catalog_backend)
     
-    display_comics_as_table(search_comics(catalog, query), config)
+    display_comics_as_table(search_comics(catalog, query, limit), config)
 
 @comics.command(name="json")
 @click.pass_context
@@ -87,20 +89,19 @@ def view_comic_json(ctx):
     query = ctx.obj["query"]
     config:Config = ctx.obj["config"]
 
-    catalog,_ = load_catalog(config.output_path)
+    catalog = open_catalog(config.output_path, config.catalog_backend)
     comic = search_comics(catalog, query)[0]
 
     console.print(Syntax(json.dumps(comic.encode(), indent=2), "json"))
 
 
 # TODO: Implement for multiple comics
-def download_missing_chapters(config:Config, comic:Comic=None):
+def download_missing_chapters(config:Config, comic:Comic=None, progress:Progress=None):
     """
     Downloads the missing chapters of a comic. Requires the chapter(s) as an option.
+    progress is a live progress display to show the download on instead of a new one.
     """
 
-    catalog,_ = load_catalog(config.output_path)
-
     # Get chapters:
     download_queue = []
 
@@ -114,8 +115,11 @@ def download_missing_chapters(config:Config, comic:Comic=None):
         progress_total += 3
         progress_total += len(chapter.pages)
     
-    with Progress() as progress:
+    packager = PackagingStage(config.output_path, workers=config.packaging_workers, max_pending=config.packaging_queue,
+                              memory_limit_mb=config.render_memory_mb, asset_workers=config.download_workers)
+    with (nullcontext(progress) if progress is not None else Progress()) as progress, packager:
         download_chapter_task = progress.add_task("[red]Downloading Chapters...", total=progress_total)
+        packager.prerender(comic, [chapter for chapter in download_queue if chapter.pages != []])
 
         if not config.download_reverse_order:
             download_queue = download_queue[::-1]
@@ -126,9 +130,10 @@ def download_missing_chapters(config:Config, comic:Comic=None):
             if chapter.pages == []:
                 log.error(f"No pages found for '{chapter.name} - {comic.name[0:40]}' It might need repairing in the catalog.")
                 continue
-            download_chapter(comic, chapter, config.output_path, config.library_path, progress, download_chapter_task)
+            download_chapter(comic, chapter, config.output_path, config.library_path, progress, download_chapter_task,
+                             workers=config.download_workers, packager=packager)
+        packager.close()
         progress.remove_task(download_chapter_task)
-    shutil.rmtree(config.output_path/"comics"/comic.slug)
 
 
 @comics.command(name="download")
@@ -142,7 +147,7 @@ def download_comic(ctx, chapters=None):
     query = ctx.obj["query"]
     config:Config = ctx.obj["config"]
 
-    catalog,_ = load_catalog(config.output_path)
+    catalog = open_catalog(config.output_path, config.catalog_backend)
     comic = search_comics(catalog, query)[0]
 
     # Get chapters:
@@ -184,8 +189,11 @@ def download_comic(ctx, chapters=None):
     if not config.download_reverse_order:
             download_queue = download_queue[::-1]
     
-    with Progress() as progress:
+    packager = PackagingStage(config.output_path, workers=config.packaging_workers, max_pending=config.packaging_queue,
+                              memory_limit_mb=config.render_memory_mb, asset_workers=config.download_workers)
+    with Progress() as progress, packager:
         download_chapter_task = progress.add_task("[red]Downloading Chapters...", total=progress_total)
+        packager.prerender(comic, [chapter for chapter in download_queue if chapter.pages != []])
 
         for i,chapter in enumerate(download_queue):
             progress.update(download_chapter_task, 
@@ -193,9 +201,10 @@ def download_comic(ctx, chapters=None):
             if chapter.pages == []:
                 log.error(f"No pages found for '{chapter.name} - {comic.name[0:40]}' It might need repairing in the catalog.")
                 continue
-            download_chapter(comic, chapter, config.output_path, config.library_path, progress, download_chapter_task)
+            download_chapter(comic, chapter, config.output_path, config.library_path, progress, download_chapter_task,
+                             workers=config.download_workers, packager=packager)
+        packager.close()
         progress.remove_task(download_chapter_task)
-    shutil.rmtree(config.output_path/"comics"/comic.slug)
 
 # FIXME: Fix for multiple queries
 @comics.command(name="add")
@@ -204,7 +213,7 @@ def add_comic_to_subscription(ctx):
     query = ctx.obj["query"]
     config:Config = ctx.obj["config"]
 
-    catalog,_ = load_catalog(config.output_path)
+    catalog = open_catalog(config.output_path, config.catalog_backend)
     comics = search_comics(catalog, query)
 
     if config.subscription_list is None:
@@ -224,7 +233,7 @@ def remove_comic_from_subscription(ctx):
     query = ctx.obj["query"]
     config:Config = ctx.obj["config"]
 
-    catalog,_ = load_catalog(config.output_path)
+    catalog = open_catalog(config.output_path, config.catalog_backend)
     comics = search_comics(catalog, query)
 
     if config.subscription_list is None:
@@ -0,0 +1,309 @@
+import hashlib
+import io
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from PIL import Image, ImageFilter, ImageEnhance, ImageDraw, ImageFont
+import numpy as np
+
+
+COVER_SIZE = (900, 1260)
+FONT_PATH = "Brush Script.ttf"
+
+# Blurs are computed on images this many times smaller than the output and then
+# scaled back up. A large gaussian blur removes all the detail that would be 
+# lost by doing so, while costing a fraction of the time and memory.
+BLUR_SCALE = 4
+
+# Only the chapter thumbnail and the chapter number differ between the chapters
+# of a volume. Everything else is rendered once per volume. The batch renderer
+# saves these base layers next to the assets, so that its worker processes load
+# them instead of rendering them again.
+
+
+def limit_memory(megabytes:int):
+    """
+    Caps how much memory the current process can map on top of what it already
+    has, by setting its virtual address space limit (RLIMIT_AS) that far above
+    its current size. Used as the initializer of cover rendering workers, so
+    that the limit only covers what their renders decode and cache, not the
+    stacks, arenas and buffers inherited from omegadl. Allocations past it raise
+    MemoryError in the render. Does nothing if megabytes is 0 or the platform
+    does not support it.
+    """
+    if not megabytes:
+        return
+
+    try:
+        import resource
+        with open("/proc/self/statm") as f:
+            mapped = int(f.read().split()[0]) * resource.getpagesize()
+    except (ImportError, OSError):
+        return
+
+    limit = mapped + megabytes * 1024 * 1024
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def open_scaled(path:Path, size:tuple[int, int]) -> Image.Image:
+    """
+    Opens an image and decodes it at the smallest resolution that is still at
+    least the given size. JPEGs are scaled down by the decoder itself (draft
+    mode), other formats are reduced right after decoding. The file is closed
+    before returning.
+    """
+    with Image.open(path) as image:
+        if image.format == "JPEG":
+            image.draft("RGB", size)
+        image.load()
+
+        factor = min(image.width // max(1, size[0]), image.height // max(1, size[1]))
+        if factor > 1:
+            return image.reduce(factor)
+        return image.copy()
+
+
+@lru_cache(maxsize=256)
+def _hash_file(path:str, size:int, mtime:float) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def asset_hash(path:Path) -> str:
+    """
+    Returns the content hash of an image asset. The hash is only recomputed when
+    the size or modification time of the file changes.
+    """
+    stat = os.stat(path)
+    return _hash_file(str(path), stat.st_size, stat.st_mtime)
+
+
+@lru_cache(maxsize=8)
+def load_font(size:int) -> ImageFont.FreeTypeFont:
+    # Load a font (you may need to specify the path to a font file on your system)
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except IOError:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=16)
+def fade_mask(width:int, height:int) -> Image.Image:
+    """
+    Returns the radial fade mask used to blend a chapter thumbnail of the given
+    size into the background.
+    """
+    small_width, small_height = max(1, width // BLUR_SCALE), max(1, height // BLUR_SCALE)
+    center = (width // 2 / BLUR_SCALE, height // 2 / BLUR_SCALE)
+    radius = (min(width // 2, height // 2) + 100) / BLUR_SCALE
+
+    # Create a gradual fade effect
+    y, x = np.ogrid[:small_height, :small_width]
+    dist_from_center = np.sqrt((x - center[0])**2 + (y - center[1])**2)
+    mask_np = np.clip((radius - dist_from_center) * BLUR_SCALE, 0, 255).astype('uint8')
+
+    # Convert back to PIL Image and apply Gaussian blur for smoother fade
+    with Image.fromarray(mask_np) as mask:
+        with mask.filter(ImageFilter.GaussianBlur(radius=20 / BLUR_SCALE)) as blurred:
+            return blurred.resize((width, height), Image.BICUBIC)
+
+
+@lru_cache(maxsize=16)
+def background_layer(comic_id, volume:str, cover_path:Path, cover_hash:str) -> Image.Image:
+    """
+    Returns the blurred volume cover every chapter cover of the volume is drawn
+    on. Cached per (comic id, volume, asset hash). The cover is decoded, laid 
+    out and blurred at 1/BLUR_SCALE of the output size and then scaled up.
+    """
+    frame_width, frame_height = COVER_SIZE[0] // BLUR_SCALE, COVER_SIZE[1] // BLUR_SCALE
+
+    with Image.open(cover_path) as source:
+        source_size = source.size
+    
+    # Resize the cover, scale height to the frame keeping aspect ratio
+    aspect_ratio = source_size[1] / source_size[0]
+    new_width = int(frame_height / aspect_ratio)
+
+    with open_scaled(cover_path, (new_width, frame_height)) as thumbnail:
+        resized_thumbnail = thumbnail.resize((new_width, frame_height), Image.LANCZOS)
+
+    # If width of frame is exceeded then apply a vertical crop
+    if new_width > frame_width:
+        left = (new_width - frame_width) // 2
+        cropped = resized_thumbnail.crop((left, 0, left + frame_width, frame_height)) # left upper right lower
+        resized_thumbnail.close()
+        resized_thumbnail = cropped
+
+    # Create a new image with the frame size and paste the resized thumbnail
+    with Image.new("RGB", (frame_width, frame_height), (0, 0, 0)) as final_image:
+        final_image.paste(resized_thumbnail, (0, 0))
+        resized_thumbnail.close()
+
+        # Blur the image and scale it to the output size
+        with final_image.filter(ImageFilter.GaussianBlur(radius=30 / BLUR_SCALE)) as blurred_image:
+            return blurred_image.resize(COVER_SIZE, Image.BICUBIC)
+
+
+@lru_cache(maxsize=16)
+def logo_layer(comic_id, logo_path:Path, logo_hash:str) -> tuple[Image.Image, Image.Image]:
+    """
+    Returns the resized logo of a comic along with its shadow. Cached per
+    (comic id, asset hash).
+    """
+    with Image.open(logo_path) as logo:
+        # Resize logo, scale width to 600 keeping aspect ratio
+        logo_aspect_ratio = logo.height / logo.width
+        logo_new_width = 600
+        logo_new_height = int(logo_new_width * logo_aspect_ratio)
+        resized_logo = logo.resize((logo_new_width, logo_new_height), Image.LANCZOS)
+
+    # Add shadow to the logo
+    shadow_drawer = ImageEnhance.Brightness(resized_logo)
+    with shadow_drawer.enhance(0.5) as shadow:
+        return resized_logo, shadow.filter(ImageFilter.GaussianBlur(radius=9))
+
+
+def render_cover(comic_id, volume:str, cover_path:Path, thumbnail_path:Path, logo_path:Path,
+                 chapter_name:str) -> bytes:
+    """
+    Renders a chapter cover from the cached volume cover, chapter thumbnail and
+    comic logo and returns it as JPEG data. thumbnail_path can be None.
+    """
+    background, resized_logo, shadow = base_layers(comic_id, volume, cover_path, logo_path)
+    return compose_cover(background, resized_logo, shadow, thumbnail_path, chapter_name)
+
+
+def base_layers(comic_id, volume:str, cover_path:Path, logo_path:Path) -> tuple[Image.Image, Image.Image, Image.Image]:
+    """
+    Returns the layers shared by every chapter cover of a volume: the blurred
+    volume cover, the logo and its shadow.
+    """
+    background = background_layer(comic_id, volume, cover_path, asset_hash(cover_path))
+    resized_logo, shadow = logo_layer(comic_id, logo_path, asset_hash(logo_path))
+    return background, resized_logo, shadow
+
+
+def prepare_base_layers(comic_id, volume:str, cover_path:Path, logo_path:Path, layers_path:Path) -> Path:
+    """
+    Renders the base layers of a volume and saves them to layers_path as an
+    uncompressed multi frame TIFF, which render_layered_cover loads. Submitted
+    as the first job of a volume by the batch renderer, so that a missing or 
+    broken asset fails the volume before its chapters.
+    """
+    background, resized_logo, shadow = base_layers(comic_id, volume, cover_path, logo_path)
+
+    # Workers of another batch may be reading the previous layers.
+    partial_path = layers_path.with_name(f"{layers_path.name}.{os.getpid()}.part")
+    background.save(partial_path, "TIFF", save_all=True, append_images=[resized_logo, shadow])
+    os.replace(partial_path, layers_path)
+    return layers_path
+
+
+@lru_cache(maxsize=4)
+def _load_layers(path:str, size:int, mtime:int) -> tuple[Image.Image, Image.Image, Image.Image]:
+    layers = []
+    with Image.open(path) as image:
+        for frame in range(3):
+            image.seek(frame)
+            image.load()
+            layers.append(image.copy())
+    return tuple(layers)
+
+
+def load_base_layers(layers_path:Path) -> tuple[Image.Image, Image.Image, Image.Image]:
+    """
+    Returns the base layers saved by prepare_base_layers. They are only read 
+    again when the size or modification time of the file changes.
+    """
+    stat = os.stat(layers_path)
+    return _load_layers(str(layers_path), stat.st_size, stat.st_mtime_ns)
+
+
+def render_layered_cover(layers_path:Path, thumbnail_path:Path, chapter_name:str) -> bytes:
+    """
+    Renders a chapter cover on the base layers saved by prepare_base_layers and
+    returns it as JPEG data. thumbnail_path can be None.
+    """
+    background, resized_logo, shadow = load_base_layers(layers_path)
+    return compose_cover(background, resized_logo, shadow, thumbnail_path, chapter_name)
+
+
+def compose_cover(background:Image.Image, resized_logo:Image.Image, shadow:Image.Image, thumbnail_path:Path,
+                  chapter_name:str) -> bytes:
+    """
+    Draws the chapter specific parts of a cover on a copy of the base layers.
+    """
+    with background.copy() as blurred_image:
+        if thumbnail_path is not None:
+            paste_overlay(blurred_image, thumbnail_path)
+
+        return draw_title(blurred_image, resized_logo, shadow, chapter_name)
+
+
+def paste_overlay(blurred_image:Image.Image, thumbnail_path:Path):
+    """
+    Fades the chapter thumbnail into the middle of the cover.
+    """
+    with Image.open(thumbnail_path) as overlay:
+        source_size = overlay.size
+
+    # Resize overlay, scale width to 800 keeping aspect ratio
+    overlay_aspect_ratio = source_size[1] / source_size[0]
+    overlay_new_width = 800
+    overlay_new_height = int(overlay_new_width * overlay_aspect_ratio)
+
+    with open_scaled(thumbnail_path, (overlay_new_width, overlay_new_height)) as overlay:
+        resized_overlay = overlay.resize((overlay_new_width, overlay_new_height), Image.LANCZOS)
+
+    with resized_overlay.convert('RGBA') as rgba_overlay:
+        resized_overlay.close()
+
+        # Apply the mask to the overlay
+        rgba_overlay.putalpha(fade_mask(overlay_new_width, overlay_new_height))
+
+        # Place the overlay on the center of the blurred image
+        overlay_x = (900 - overlay_new_width) // 2
+        overlay_y = ((1260 - overlay_new_height) // 2) + 200
+        blurred_image.paste(rgba_overlay, (overlay_x, overlay_y), rgba_overlay)
+
+
+def draw_title(blurred_image:Image.Image, resized_logo:Image.Image, shadow:Image.Image, chapter_name:str) -> bytes:
+    """
+    Draws the logo and the chapter number on the cover and returns it as JPEG data.
+    """
+
+    # Place logo and shadow on the center of the frame
+    logo_x = (900 - resized_logo.width) // 2
+    logo_y = ((1260 - resized_logo.height) // 2) - 240
+
+    blurred_image.paste(shadow, (logo_x + 5, logo_y + 5), shadow)
+    blurred_image.paste(resized_logo, (logo_x, logo_y), resized_logo)
+
+    # Add chapter number to the bottom right corner
+    chapter_number = chapter_name.replace("Chapter ","")
+    draw = ImageDraw.Draw(blurred_image)
+    font = load_font(110)
+
+    text = f"#{chapter_number}"
+    text_width = draw.textlength(text, font=font)
+    text_height = 110
+
+    # Position text in bottom right with 10px margin
+    text_x = 900 - text_width - 70
+    text_y = 1260 - text_height - 30
+
+    # Add text shadow
+    shadow_offset = 2
+    draw.text((text_x + shadow_offset, text_y + shadow_offset), text, font=font, fill=(0, 0, 0, 20))
+
+    # Add main text
+    draw.text((text_x, text_y), text, font=font, fill=(255, 255, 255, 255))
+
+    # Export image as jpeg
+    cover = io.BytesIO()
+    blurred_image.save(cover, "JPEG", quality=95)
+    return cover.getvalue()
@@ -1,200 +1,353 @@
 import requests
 from pathlib import Path
 import os
-from omegadl.utils import zip_files, list_files_abs
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, InvalidStateError, as_completed
+from omegadl import transport
+from omegadl.archive import ChapterArchive
 from omegadl.objects import Comic, Chapter
 from omegadl.comicxml import ComicInfo, Manga, AgeRating, create_comic_info_xml
 import xml.etree.ElementTree as ET
-from PIL import Image, ImageFilter, ImageEnhance, ImageDraw, ImageFont
-import numpy as np
+from omegadl.covers import render_cover, render_layered_cover, prepare_base_layers, limit_memory
 from rich.progress import Progress
 
+log = logging.getLogger("rich")
 
-def zip_chapter(input_dir:Path, output_dir:Path, comic:Comic, chapter:Chapter):
-    files = list_files_abs(input_dir)
-    out = output_dir / comic.name
-    os.makedirs(out, exist_ok=True)
-    output = Path( out / f"{comic.name} Vol.{chapter.get_volume(comic)} Ch.{chapter.slug.split('-')[1]}.cbz")
-    if os.path.exists(output):
-        os.remove(output)
-    zip_files(files,output )
 
-
-def download(url, output_dir, filename=None, overwrite:bool=False):
+def download(url, output_dir, filename=None, overwrite:bool=False, chunk_size:int=64*1024):
+    """
+    Streams a file to output_dir in chunks. The data is written to a .part file
+    which is renamed to its final name only once the number of bytes received
+    matches the Content-Length, so a truncated or failed download is never 
+    mistaken for a finished one. An existing .part file from an interrupted
+    download is resumed with an HTTP Range request.
+    """
     if filename is None:
         filename = url.split('/')[-1].split('?')[0]
-    if os.path.exists( output_dir / filename) and not overwrite:
+    target = Path(output_dir) / filename
+    partial = Path(output_dir) / f"{filename}.part"
+
+    if os.path.exists(target) and not overwrite:
         return
-    r = requests.get(url)
-    with open(output_dir / filename, "wb") as f:
-        f.write(r.content)
+    if overwrite and os.path.exists(partial):
+        os.remove(partial)
+
+    for _ in range(2):
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with transport.get(url, headers=headers, stream=True) as r:
+            # The .part file is already complete or larger than the remote file.
+            if r.status_code == 416:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                continue
+
+            if r.status_code == 206 and r.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                mode = "ab"
+            elif r.status_code == 200:
+                # The server ignored the range, start over.
+                offset = 0
+                mode = "wb"
+            else:
+                raise requests.HTTPError(f"Downloading {url} failed with status code {r.status_code}", response=r)
+
+            expected = None
+            if "Content-Length" in r.headers and r.headers.get("Content-Encoding", "identity") == "identity":
+                expected = offset + int(r.headers["Content-Length"])
+
+            with open(partial, mode) as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+        break
+    else:
+        raise requests.HTTPError(f"Downloading {url} failed, the server kept answering 416 after the .part file "
+                                 f"was discarded")
+
+    received = os.path.getsize(partial)
+    if expected is not None and received != expected:
+        # Keep the .part file so that the next attempt resumes from here.
+        raise IOError(f"Downloading {url} ended after {received} of {expected} bytes")
+
+    os.replace(partial, target)
+
+
+def download_to(url, fileobj, chunk_size:int=64*1024) -> int:
+    """
+    Streams a file into the given file object and returns the number of bytes
+    written. Raises if the response is not a 200 or ends short of its 
+    Content-Length.
+    """
+    with transport.get(url, stream=True) as r:
+        if r.status_code != 200:
+            raise requests.HTTPError(f"Downloading {url} failed with status code {r.status_code}", response=r)
+
+        expected = None
+        if "Content-Length" in r.headers and r.headers.get("Content-Encoding", "identity") == "identity":
+            expected = int(r.headers["Content-Length"])
+
+        received = 0
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            fileobj.write(chunk)
+            received += len(chunk)
+
+    if expected is not None and received != expected:
+        raise IOError(f"Downloading {url} ended after {received} of {expected} bytes")
+    return received
+
+
+def download_page(url, archive:ChapterArchive, filename:str, retries:int=2, spool_size:int=8*1024*1024):
+    """
+    Downloads a page and appends it to the chapter archive. The page is buffered
+    in memory (spilling over to a temporary file for very tall pages) so that a
+    failed transfer can be retried without leaving a broken entry in the archive.
+    """
+    for attempt in range(retries + 1):
+        with tempfile.SpooledTemporaryFile(max_size=spool_size) as spool:
+            try:
+                download_to(url, spool)
+            except IOError as e:
+                if attempt == retries:
+                    raise e
+                continue
+
+            spool.seek(0)
+            archive.write_stream(filename, spool)
+            return
+
+
+def page_filename(index:int, url:str) -> str:
+    """
+    Returns a zero padded filename for the page at the given index so that the
+    pages keep their reading order inside the archive.
+    """
+    extension = os.path.splitext(url.split('/')[-1].split('?')[0])[1]
+    return f"{index+1:04d}{extension}"
 
 
 # FIXME: Fix comic xml output.
-def generate_comic_xml(comic:Comic, chapter:Chapter, out_path:Path) -> str:
+def generate_comic_xml(comic:Comic, chapter:Chapter) -> bytes:
     comic_info = ComicInfo()
-    comic.title = comic.name
-    comic.volume = 1
-    comic.number = chapter.slug
-    # comic.summary = "This is an example comic."
-    # comic.year = 2023
-    comic.language_iso = "en"
-    comic.manga = Manga.YES
-    comic.age_rating = AgeRating.X18_PLUS
+    comic_info.title = comic.name
+    comic_info.volume = 1
+    comic_info.number = chapter.slug
+    # comic_info.summary = "This is an example comic."
+    # comic_info.year = 2023
+    comic_info.language_iso = "en"
+    comic_info.manga = Manga.YES
+    comic_info.age_rating = AgeRating.X18_PLUS
 
     root = create_comic_info_xml(comic_info)
-    tree = ET.ElementTree(root)
-    tree.write(out_path / "ComicInfo.xml", encoding="utf-8", xml_declaration=True)
-
-
-def download_chapter(comic:Comic, chapter:Chapter, output_dir:Path, library_dir:Path, progress:Progress=None, task=None):
-
-    out = output_dir / "comics" / comic.slug / chapter.slug
-    os.makedirs(out, exist_ok=True)
+    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
 
-    generate_chapter_cover(comic,chapter, output_dir)
-    progress.update(task, advance=1, description="[green]Generating Chapter ComicInfo.xml...")
 
-    # Generate ComicXML
-    generate_comic_xml(comic, chapter, out)
-    progress.update(task, advance=1, description="[green]Downloading Chapter pages...")
+def download_chapter(comic:Comic, chapter:Chapter, output_dir:Path, library_dir:Path, progress:Progress=None, task=None,
+                     workers:int=8, packager=None):
+    """
+    Downloads a chapter straight into its .cbz in the library along with its
+    cover and ComicInfo.xml. If a PackagingStage is given, the cover is rendered
+    on it while the pages download and the archive is finished in the background,
+    so this returns as soon as the last page is in.
+    """
 
-    urls = chapter.pages
-    for i,url in enumerate(urls):
-        progress.update(task, description=f"[green]Downloading pages [{i+1}/{len(chapter.pages)}]  {chapter.name} - {comic.name[:45]}...")
-        # print("Downloading ", url)
-        download(url, out)
-        progress.update(task, advance=1)
-
-    zip_chapter(out, library_dir, comic, chapter)  
-    progress.update(task, advance=1) 
-
-
-def generate_chapter_cover(comic:Comic, chapter:Chapter, output_dir:Path):
+    archive = ChapterArchive(chapter.archive_path(comic, library_dir))
 
+    try:
+        if packager is not None:
+            cover = packager.render(comic, chapter)
+            archive.write("ComicInfo.xml", generate_comic_xml(comic, chapter))
+            progress.update(task, advance=1, description="[green]Downloading Chapter pages...")
+        else:
+            archive.write("cover.jpg", generate_chapter_cover(comic, chapter, output_dir))
+            progress.update(task, advance=1, description="[green]Generating Chapter ComicInfo.xml...")
+
+            # Generate ComicXML
+            archive.write("ComicInfo.xml", generate_comic_xml(comic, chapter))
+            progress.update(task, advance=1, description="[green]Downloading Chapter pages...")
+
+        # Pages are fetched by a bounded pool of workers. Each page gets a filename
+        # derived from its index so completion order does not affect page order.
+        urls = chapter.pages
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(download_page, url, archive, page_filename(i, url)) for i,url in enumerate(urls)]
+            for i,future in enumerate(as_completed(futures)):
+                future.result()
+                progress.update(task, advance=1, description=f"[green]Downloading pages [{i+1}/{len(urls)}]  {chapter.name} - {comic.name[:45]}...")
+    except BaseException as e:
+        archive.abort()
+        raise e
+
+    if packager is not None:
+        packager.package(archive, cover, on_done=lambda: progress.update(task, advance=2))
+    else:
+        archive.commit()
+        progress.update(task, advance=1) 
+
+
+def download_volume_assets(comic:Comic, chapter:Chapter, output_dir:Path):
+    """
+    Downloads the volume cover and the logo the covers of a chapter's volume are
+    rendered from into the image cache. Files that are already cached are 
+    skipped.
+    """
     comic_image_cache_dir:Path = output_dir / "cache" / "images"
     os.makedirs(comic_image_cache_dir, exist_ok=True)
 
+    download(comic.get_cover(chapter), comic_image_cache_dir, filename= f"{comic.id}_cover{chapter.get_volume(comic)}.jpg")
+    download(comic.get_logo(), comic_image_cache_dir, filename= f"{comic.id}_logo.png")
+
+
+def download_cover_assets(comic:Comic, chapter:Chapter, output_dir:Path):
+    """
+    Downloads the images a chapter cover is rendered from into the image cache.
+    Files that are already cached are skipped.
+    """
+    download_volume_assets(comic, chapter, output_dir)
     if chapter.is_breakpoint(comic):
-        download(comic.get_cover(chapter), output_dir / "comics" / comic.slug / chapter.slug, filename= "cover.jpg")
         return
 
-    # Download Comic Cover
-    download(comic.get_cover(chapter), comic_image_cache_dir, filename= f"{comic.id}_cover{chapter.get_volume(comic)}.jpg")
-    thumbnail = Image.open(comic_image_cache_dir / f"{comic.id}_cover{chapter.get_volume(comic)}.jpg")
-
-    # Resize chapter thumbnail, scale height to 1260 keeping aspect ratio
-    aspect_ratio = thumbnail.height / thumbnail.width
-    new_height = 1260
-    new_width = int(new_height / aspect_ratio)
-    resized_thumbnail = thumbnail.resize((new_width, new_height), Image.LANCZOS)
-
-    # If width of frame > 900 then apply a vertical crop
-    if new_width > 900:
-        left = (new_width/2) - (450)
-        right = (new_width/2) + (450)
-        resized_thumbnail = resized_thumbnail.crop((left, 0, right, 1260)) # left upper right lower
-        new_height = 1260
-
-    # Create a new image with the final resolution and paste the resized thumbnail in the center
-    final_image = Image.new("RGB", (900, 1260), (0, 0, 0))
-    paste_x = (1260 - new_width) // 2
-    # paste_y = (900 - new_height) // 2
-    final_image.paste(resized_thumbnail, (0, 0))
-
-    # Blur the image
-    blurred_image = final_image.filter(ImageFilter.GaussianBlur(radius=30))
-
     if chapter.thumbnail_url is not None:
-        # Download the chapter thumbnail
-        download(chapter.thumbnail_url, comic_image_cache_dir, filename= f"{comic.id}_{chapter.id}_cover.jpg")
-        overlay = Image.open(comic_image_cache_dir / f"{comic.id}_{chapter.id}_cover.jpg")
-
-        # Resize overlay, scale width to 800 keeping aspect ratio
-        overlay_aspect_ratio = overlay.height / overlay.width
-        overlay_new_width = 800
-        overlay_new_height = int(overlay_new_width * overlay_aspect_ratio)
-        resized_overlay = overlay.resize((overlay_new_width, overlay_new_height), Image.LANCZOS)
-
-        mask = Image.new('L', resized_overlay.size, 0)
-        draw = ImageDraw.Draw(mask)
-        center = (overlay_new_width // 2, overlay_new_height // 2)
-        radius = min(center[0], center[1]) + 100
-        draw.ellipse([center[0] - radius, center[1] - radius, 
-                    center[0] + radius, center[1] + radius], fill=255)
-
-        # Create a gradual fade effect
-        mask_np = np.array(mask)
-        y, x = np.ogrid[:overlay_new_height, :overlay_new_width]
-        dist_from_center = np.sqrt((x - center[0])**2 + (y - center[1])**2)
-        mask_np = np.clip(radius - dist_from_center, 0, 255).astype('uint8')
-
-        # Convert back to PIL Image and apply Gaussian blur for smoother fade
-        mask = Image.fromarray(mask_np)
-        mask = mask.filter(ImageFilter.GaussianBlur(radius=20))
-
-        # Apply the mask to the overlay
-        if resized_overlay.mode != 'RGBA':
-            resized_overlay = resized_overlay.convert('RGBA')
-
-        # Apply the mask to the overlay
-        resized_overlay.putalpha(mask)
-
-        # Place the overlay on the center of the blurred image
-        overlay_x = (900 - overlay_new_width) // 2
-        overlay_y = ((1260 - overlay_new_height) // 2) + 200
-        blurred_image.paste(resized_overlay, (overlay_x, overlay_y), resized_overlay)
-
-    # Download logo
-    logo_url = comic.get_logo()
-    download(logo_url, comic_image_cache_dir, filename= f"{comic.id}_logo.png")
-    logo = Image.open(comic_image_cache_dir / f"{comic.id}_logo.png")
-
-    # Resize logo, scale width to 600 keeping aspect ratio
-    logo_aspect_ratio = logo.height / logo.width
-    logo_new_width = 600
-    logo_new_height = int(logo_new_width * logo_aspect_ratio)
-    resized_logo = logo.resize((logo_new_width, logo_new_height), Image.LANCZOS)
-
-    # Add shadow to the logo
-    shadow = Image.new("RGBA", resized_logo.size, (0, 0, 0, 0))
-    shadow_drawer = ImageEnhance.Brightness(resized_logo)
-    shadow = shadow_drawer.enhance(0.5)
-    shadow = shadow.filter(ImageFilter.GaussianBlur(radius=9))
-
-    # Place logo and shadow on the center of the frame
-    logo_x = (900 - logo_new_width) // 2
-    logo_y = ((1260 - logo_new_height) // 2) - 240
-
-    blurred_image.paste(shadow, (logo_x + 5, logo_y + 5), shadow)
-    blurred_image.paste(resized_logo, (logo_x, logo_y), resized_logo)
-
-    # Add chapter number to the bottom right corner
-    chapter_number = chapter.name.replace("Chapter ","")
-    draw = ImageDraw.Draw(blurred_image)
-
-    # Load a font (you may need to specify the path to a font file on your system)
-    try:
-        font = ImageFont.truetype("Brush Script.ttf", 110)
-    except IOError:
-        font = ImageFont.load_default()
+        download(chapter.thumbnail_url, output_dir / "cache" / "images", filename= f"{comic.id}_{chapter.id}_cover.jpg")
 
-    text = f"#{chapter_number}"
-    text_width = draw.textlength(text, font=font)
-    text_height = 110
 
-    # Position text in bottom right with 10px margin
-    text_x = 900 - text_width - 70
-    text_y = 1260 - text_height - 30
+def generate_chapter_cover(comic:Comic, chapter:Chapter, output_dir:Path) -> bytes:
+    """
+    Renders the cover of a chapter and returns it as JPEG data. Chapters that
+    start a volume use the volume cover as is.
+    """
 
-    # Add text shadow
-    shadow_offset = 2
-    draw.text((text_x + shadow_offset, text_y + shadow_offset), text, font=font, fill=(0, 0, 0, 20))
+    comic_image_cache_dir:Path = output_dir / "cache" / "images"
 
-    # Add main text
-    draw.text((text_x, text_y), text, font=font, fill=(255, 255, 255, 255))
+    # Download Comic Cover, chapter thumbnail and logo
+    download_cover_assets(comic, chapter, output_dir)
 
-    # Export image as image.jpg
-    blurred_image.save(output_dir / "comics" / comic.slug / chapter.slug / "cover.jpg", "JPEG", quality=95)
+    volume = chapter.get_volume(comic)
+    cover_path = comic_image_cache_dir / f"{comic.id}_cover{volume}.jpg"
 
+    if chapter.is_breakpoint(comic):
+        with open(cover_path, "rb") as f:
+            return f.read()
 
+    thumbnail_path = None
+    if chapter.thumbnail_url is not None:
+        thumbnail_path = comic_image_cache_dir / f"{comic.id}_{chapter.id}_cover.jpg"
+
+    return render_cover(comic.id, volume, cover_path, thumbnail_path, 
+                        comic_image_cache_dir / f"{comic.id}_logo.png", chapter.name)
+
+
+def submit_chapter_covers(executor, jobs:list[tuple[Comic, Chapter]], output_dir:Path, 
+                          asset_executor:ThreadPoolExecutor) -> list[Future]:
+    """
+    Renders the covers of a list of (comic, chapter) jobs on a process pool and
+    returns a future holding the JPEG data of each job, in order. Returns right
+    away: every chapter fetches its thumbnail on the asset executor and is then
+    rendered on its own. The base layers of a volume are rendered once, by the
+    first process pool job of the volume, and saved to the image cache, from
+    where the jobs of its chapters load them. A chapter whose thumbnail cannot
+    be fetched gets a cover without it.
+    #   executor: A ProcessPoolExecutor
+    #   asset_executor: Thread pool the cover images are downloaded on
+    """
+    comic_image_cache_dir:Path = output_dir / "cache" / "images"
+    covers = [Future() for _ in jobs]
+    layers: dict[tuple, Future] = {}
+    layers_lock = threading.Lock()
+
+    def volume_layers(comic:Comic, chapter:Chapter, volume:str) -> Future:
+        # The first chapter of a volume to get here downloads the shared assets
+        # and submits the base layers, the others wait on the same future, which
+        # holds the path of the saved layers. This way no two threads write the
+        # same file.
+        with layers_lock:
+            if (comic.id, volume) in layers:
+                return layers[(comic.id, volume)]
+            future = layers[(comic.id, volume)] = Future()
+
+        try:
+            download_volume_assets(comic, chapter, output_dir)
+            render = executor.submit(prepare_base_layers, comic.id, volume, comic_image_cache_dir / f"{comic.id}_cover{volume}.jpg",
+                                     comic_image_cache_dir / f"{comic.id}_logo.png", 
+                                     comic_image_cache_dir / f"{comic.id}_layers{volume}.tiff")
+            render.add_done_callback(lambda f: _chain(f, future))
+        except BaseException as e:
+            _settle(future, exception=e)
+        return future
+
+    def render_chapter(cover:Future, comic:Comic, chapter:Chapter):
+        try:
+            volume = chapter.get_volume(comic)
+            shared = volume_layers(comic, chapter, volume)
+
+            if chapter.is_breakpoint(comic):
+                # Chapters that start a volume use the volume cover as is.
+                shared.result()
+                with open(comic_image_cache_dir / f"{comic.id}_cover{volume}.jpg", "rb") as f:
+                    _settle(cover, f.read())
+                return
+
+            thumbnail_path = None
+            if chapter.thumbnail_url is not None:
+                thumbnail_path = comic_image_cache_dir / f"{comic.id}_{chapter.id}_cover.jpg"
+                try:
+                    download(chapter.thumbnail_url, comic_image_cache_dir, filename=thumbnail_path.name)
+                except IOError as e:
+                    log.warning(f"Could not fetch the thumbnail of {chapter.name} - {comic.name[:45]}, "
+                                f"rendering its cover without it: {e}")
+                    thumbnail_path = None
+
+            render = executor.submit(render_layered_cover, shared.result(), thumbnail_path, chapter.name)
+            render.add_done_callback(lambda f: _chain(f, cover))
+        except BaseException as e:
+            _settle(cover, exception=e)
+
+    for cover, (comic, chapter) in zip(covers, jobs):
+        asset_executor.submit(render_chapter, cover, comic, chapter)
+
+    return covers
+
+
+def _settle(future:Future, result=None, exception:BaseException=None):
+    # The future may have been cancelled by the packager in the meantime.
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def _chain(source:Future, target:Future):
+    if source.cancelled():
+        _settle(target, exception=InterruptedError("Cover rendering was cancelled"))
+    elif source.exception() is not None:
+        _settle(target, exception=source.exception())
+    else:
+        _settle(target, source.result())
+
+
+def render_chapter_covers(jobs:list[tuple[Comic, Chapter]], output_dir:Path, out_dir:Path, 
+                          workers:int=None, memory_limit_mb:int=0, asset_workers:int=8) -> list[Path]:
+    """
+    Renders the covers of a list of (comic, chapter) jobs across a process pool
+    and writes each one to out_dir/<comic slug>/<chapter slug>/cover.jpg.
+    Returns the paths of the covers in the order of the jobs.
+    """
+    workers = workers or os.cpu_count()
+    paths = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=limit_memory, initargs=(memory_limit_mb,)) as executor, \
+            ThreadPoolExecutor(max_workers=asset_workers) as asset_executor:
+        covers = submit_chapter_covers(executor, jobs, output_dir, asset_executor)
+
+        for (comic, chapter), cover in zip(jobs, covers):
+            path = Path(out_dir) / comic.slug / chapter.slug / "cover.jpg"
+            os.makedirs(path.parent, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(cover.result())
+            paths.append(path)
+
+    return paths
@@ -1,14 +1,17 @@
-import requests
 import json
+import requests
 import random
-import os
-from omegadl.utils import slugify
+from omegadl import transport
+from omegadl.cache import get_cache, revalidates, digest
 from pathlib import Path
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from rich.logging import RichHandler
 from omegadl.objects import Comic, dict_to_chapter, dict_to_comic, Chapter
 
 from omegadl.objects import BreakPointOperators
+from omegadl.chapterdiff import diff_chapters, merge_chapters
 from omegadl.utils import trailing_int
 
 
@@ -18,6 +21,9 @@ logging.basicConfig(
 )
 log = logging.getLogger("rich")
 
+_page_executor: ThreadPoolExecutor = None
+_page_executor_lock = threading.Lock()
+
 
 def read_cookies() -> dict:
     try:
@@ -67,6 +73,7 @@ def generate_random_headers():
 def update_comic_metadata(local:Comic, remote:Comic) -> Comic:
     chapters = local.chapters
     remote.chapters = chapters
+    remote.paywalled = local.paywalled
 
     covers = local.covers
     
@@ -91,44 +98,108 @@ def update_comic_metadata(local:Comic, remote:Comic) -> Comic:
     return remote
 
 
-def _fetch(search_url:str, dump:bool, output_dir:Path=None) -> dict:
-    dump_dir = output_dir / "cache" / "requests"
+def _revalidate(search_url:str, output_dir:Path) -> tuple[str, float]:
+    """
+    Fetches a url with conditional request headers built from the validators of 
+    its cached response. Returns the body and, if it is unchanged since it was 
+    cached, the time the cached body was stored, else None. A body is unchanged
+    if the server answered 304 or the new body hashes to the same digest.
+    """
+    response_cache = get_cache(output_dir)
+    entry = response_cache.lookup(search_url)
+
+    headers = generate_random_headers()
+    if entry is not None:
+        if entry.etag is not None:
+            headers["if-none-match"] = entry.etag
+        if entry.last_modified is not None:
+            headers["if-modified-since"] = entry.last_modified
+
+    response = transport.get(search_url, headers=headers, cookies=read_cookies())
+
+    if response.status_code == 304 and entry is not None:
+        response_cache.touch(search_url)
+        return entry.body, entry.stored_at
+
+    if response.status_code != 200:
+        log.error(f"Request failed with status code: {response.status_code}")
+        log.debug(f"Response content: \n{response.text}")
+        raise requests.HTTPError(f"Request to {search_url} failed with status code {response.status_code}", 
+                                 response=response)
+
+    if entry is not None and entry.digest == digest(response.text):
+        response_cache.touch(search_url)
+        return entry.body, entry.stored_at
+
+    response_cache.record_miss(search_url)
+    response_cache.put(search_url, response.text, etag=response.headers.get("ETag"), 
+                       last_modified=response.headers.get("Last-Modified"))
+    return response.text, None
+
+
+def _fetch(search_url:str, dump:bool, output_dir:Path=None, unchanged_since:float=None) -> dict:
+    """
+    Fetches a url from the api, going through the response cache if dump is set.
+    #   unchanged_since: Return None instead of the response when the cache is 
+    #                    being revalidated and the response did not change since 
+    #                    it was stored, at or before this timestamp.
+    """
     resp = None
     sc = 0
 
-    if dump:
-        os.makedirs(dump_dir, exist_ok=True)
-        try:
-            with open(dump_dir / (slugify(search_url)+".txt"), "r") as f:
-                resp = f.read()
-                sc = 200
+    if dump and revalidates(search_url):
+        resp, stored_at = _revalidate(search_url, output_dir)
+        sc = 200
+        # A body stored after unchanged_since may not have made it anywhere yet,
+        # e.g. when the run that stored it was aborted.
+        if unchanged_since is not None and stored_at is not None and stored_at <= unchanged_since:
+            return None
+
+    elif dump:
+        resp = get_cache(output_dir).get(search_url)
+        if resp is not None:
+            sc = 200
             # log.debug(f"Fetched request cache for: {search_url}")
-        except:
-            pass
 
     if resp is None:
-        response = requests.get(search_url, headers=generate_random_headers(), cookies=read_cookies())
+        response = transport.get(search_url, headers=generate_random_headers(), cookies=read_cookies())
         sc = response.status_code
         resp = response.text
+
+        if dump and sc == 200:
+            get_cache(output_dir).put(search_url, resp, etag=response.headers.get("ETag"), 
+                                      last_modified=response.headers.get("Last-Modified"))
     
-    if sc == 200:
-        try:
-            response_dict = json.loads(resp)            
-        except json.JSONDecodeError:
-            log.error("Failed to decode JSON. The response might not be in JSON format.")
-            log.info(search_url)
-            log.info(resp)
-    else:
-        log.error(f"Request failed with status code: {response.status_code}")
+    if sc != 200:
+        log.error(f"Request failed with status code: {sc}")
         log.debug(f"Response content: \n{resp}")
-    
+        raise requests.HTTPError(f"Request to {search_url} failed with status code {sc}", response=response)
 
-    with open(dump_dir / (slugify(search_url)+".txt"), "w") as f:
-        f.write(resp)
+    try:
+        response_dict = json.loads(resp)            
+    except json.JSONDecodeError as e:
+        log.error("Failed to decode JSON. The response might not be in JSON format.")
+        log.info(search_url)
+        log.info(resp)
+        raise e
     
     return response_dict
 
 
+def get_page_executor(workers:int=4) -> ThreadPoolExecutor:
+    """
+    Returns the executor shared by every chapter page lookup. Its worker count is
+    the global cap on in-flight chapter requests, no matter how many comics are
+    being processed at once. The first caller decides the size of the pool.
+    """
+    global _page_executor
+
+    with _page_executor_lock:
+        if _page_executor is None:
+            _page_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="omegadl-pages")
+    return _page_executor
+
+
 def get_chapter_pages(output_dir:Path, comic:dict, chapter:dict, cache:bool) -> list:
     """
     Get all image urls of pages of a particular chapter of a comic.
@@ -149,31 +220,30 @@ def get_chapter_pages(output_dir:Path, comic:dict, chapter:dict, cache:bool) ->
         return 'paywall'
 
 
-def get_comic_list(output_dir:Path, cache:bool) -> list[Comic]:
+def get_comic_list(output_dir:Path, cache:bool, workers:int=4) -> list[Comic]:
     """
     Get all the comics along with their basic metadata from omegascans.
     output_dir: Pass in the output directory for omegadl
+    workers: Number of listing pages fetched in parallel after the first one
     """
 
-    current_page = 1
-    last_page = 100
     search_url = f"https://api.omegascans.org/query?adult=true"
-    data = []
 
-    
-    # Iterate through search results
-    while current_page<=last_page:
-        response = _fetch(search_url, dump=cache, output_dir=output_dir)
-        data.extend(response['data'])
-
-        if current_page==1:
-            # print("Total comics found: ", response['meta']['total'])
-            last_page = int(response['meta']['last_page'])
-        # else:
-        #     print("Fetched page ", current_page) 
-
-        current_page +=1
-        search_url= search_url.split("&page=")[0] + f"&page={current_page}"
+    # The first page tells us how many pages there are in total.
+    response = _fetch(search_url, dump=cache, output_dir=output_dir)
+    last_page = int(response['meta']['last_page'])
+    pages = {1: response['data']}
+
+    # Fetch the remaining pages concurrently and put them back in page order.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_fetch, f"{search_url}&page={page}", cache, output_dir): page 
+                   for page in range(2, last_page+1)}
+        for future in as_completed(futures):
+            pages[futures[future]] = future.result()['data']
+
+    data = []
+    for page in sorted(pages):
+        data.extend(pages[page])
     
     comic_list = []
     
@@ -185,74 +255,183 @@ def get_comic_list(output_dir:Path, cache:bool) -> list[Comic]:
     
     return comic_list
 
-# TODO: Adjust perPage argument according to missing chapters when updating.
-def get_chapter_list(output_dir:Path, comic:dict, cache:bool) -> list[Chapter]:
+
+def get_updated_comic_list(output_dir:Path, cache:bool, watermark:str=None, workers:int=4) -> tuple[list[Comic], bool]:
+    """
+    Get the comics updated since the watermark, the latest updated_at in the
+    local catalog. The listing is crawled most recently updated first and stops
+    at the first page reaching past the watermark. Returns the comics along with
+    whether the listing is complete, which it is when every comic was listed.
+    Falls back to the full listing if there is no watermark or the listing does
+    not come back in order.
+    #   watermark: updated_at of the most recently updated comic in the catalog
+    """
+    if watermark is None:
+        return get_comic_list(output_dir, cache, workers), True
+
+    search_url = f"https://api.omegascans.org/query?adult=true&orderBy=updated_at&order=desc"
+
+    data = []
+    page = last_page = 1
+    while page <= last_page:
+        response = _fetch(f"{search_url}&page={page}", dump=cache, output_dir=output_dir)
+        last_page = int(response['meta']['last_page'])
+
+        for comic_dict in response['data']:
+            if data and comic_dict['updated_at'] > data[-1]['updated_at']:
+                log.debug("Comic listing is not ordered by update time, fetching the full listing.")
+                return get_comic_list(output_dir, cache, workers), True
+            data.append(comic_dict)
+
+        # Comics updated at the watermark itself are still listed, they might 
+        # not all have been in the catalog.
+        if data and data[-1]['updated_at'] < watermark:
+            break
+        page += 1
+
+    comic_list = [dict_to_comic(comic_dict) for comic_dict in data 
+                  if comic_dict['series_type'] == "Comic" and comic_dict['updated_at'] >= watermark]
+
+    return comic_list, page > last_page
+
+
+# Number of chapters asked for by the first request of an update. Most updates
+# find at most a couple of new chapters, so this usually is the only request.
+UPDATE_PAGE_SIZE = 5
+
+
+def _query_chapters(output_dir:Path, comic:Comic, cache:bool, page:int, per_page:int, 
+                    unchanged_since:float=None) -> dict:
+    request_url = f"https://api.omegascans.org/chapter/query?page={page}&perPage={per_page}&series_id={comic.id}"
+    return _fetch(request_url, dump=cache, output_dir=output_dir, unchanged_since=unchanged_since)
+
+
+def get_chapter_list(output_dir:Path, comic:dict, cache:bool, unchanged_since:float=None) -> list[Chapter]:
     """
     Returns the list of chapters for a given comic
     #   output_dir: Location of the output directory
     #   comic: The comic dictionary object 
+    #   unchanged_since: Return None if the cached chapter list was revalidated 
+    #                    and found unchanged since this timestamp
     """
 
-    request_url = f"https://api.omegascans.org/chapter/query?page=1&perPage=1999&series_id={comic.id}"
-    response: list = _fetch(request_url, dump=cache, output_dir=output_dir)['data']
+    response = _query_chapters(output_dir, comic, cache, page=1, per_page=1999, unchanged_since=unchanged_since)
+
+    if response is None:
+        return None
     
     chapter_list = []
-    for chapter_dict in response:
+    for chapter_dict in response['data']:
         chapter_list.append(dict_to_chapter(chapter_dict))
     
     return chapter_list
 
 
-def get_chapters(output_dir:Path, comic:dict, update:bool, cache:bool) -> list:
+def get_updated_chapter_list(output_dir:Path, comic:Comic, cache:bool, unchanged_since:float=None) -> list[Chapter]:
+    """
+    Returns the list of chapters for a comic that already has chapters in the
+    catalog, only fetching the ones newer than those. Chapters are requested
+    newest first, UPDATE_PAGE_SIZE at first, and every further request asks for
+    as many chapters as were fetched so far, until a known chapter shows up.
+    Falls back to the full list if the remote total does not add up with the
+    chapters in the catalog and the paywalled ones left out of it, e.g. when
+    older chapters were removed.
+    #   unchanged_since: Return None if the first page was revalidated and found 
+    #                    unchanged since this timestamp
+    """
+    known = {chapter.id for chapter in comic.chapters}
+    new_chapters = []
+
+    page, per_page = 1, UPDATE_PAGE_SIZE
+    while True:
+        response = _query_chapters(output_dir, comic, cache, page, per_page, 
+                                   unchanged_since=unchanged_since if page == 1 else None)
+        if response is None:
+            return None
+
+        found = False
+        for chapter_dict in response['data']:
+            chapter = dict_to_chapter(chapter_dict)
+            if chapter.id in known:
+                found = True
+                break
+            new_chapters.append(chapter)
+
+        if found or len(response['data']) < per_page:
+            break
+
+        # page * per_page chapters have been fetched so far. Asking for page 2
+        # at that page size skips exactly those and fetches as many again, so
+        # the window doubles with every request: 5, then 5 more, 10, 20, ...
+        page, per_page = 2, page * per_page
+
+    new_ids = {chapter.id for chapter in new_chapters}
+    paywalled = [id for id in comic.paywalled if id not in new_ids]
+
+    total = response.get('meta', {}).get('total')
+    if total is not None and int(total) != len(new_chapters) + len(comic.chapters) + len(paywalled):
+        log.debug(f"Chapter count of {comic.name} does not add up, fetching the full chapter list.")
+        chapter_list = get_chapter_list(output_dir, comic, cache)
+        # Paywalled chapters that are no longer listed would keep the count off.
+        listed = {chapter.id for chapter in chapter_list}
+        comic.paywalled = [id for id in comic.paywalled if id in listed]
+        return chapter_list
+
+    return new_chapters + comic.chapters
+
+
+def get_chapters(output_dir:Path, comic:dict, update:bool, cache:bool, workers:int=4, 
+                 synced_at:float=None) -> list:
     """
     Takes in the local catalog's comic object and then fetches all the chapters 
     of the title that are missing in the case update is true.
     # output_dir:
     # comic:    
     # update: 
+    # workers: Size of the shared chapter page executor
+    # synced_at: Timestamp the local catalog was last saved at. Chapter lists 
+    #            cached before then that are still unchanged are not compared.
     """
 
     
-    chapter_list = get_chapter_list(output_dir, comic, cache)
-    page_fetch_queue = []
+    if update and comic.chapters != []:
+        chapter_list = get_updated_chapter_list(output_dir, comic, cache, unchanged_since=synced_at)
+    else:
+        chapter_list = get_chapter_list(output_dir, comic, cache)
 
-    page_fetch_queue = chapter_list.copy() # Initially add all chapters to queue
+    # Nothing to parse or compare if the chapter list did not change since last time.
+    if chapter_list is None:
+        return comic.chapters
 
-    if update:
-        if len(chapter_list) == len(comic.chapters):
-            return comic.chapters
-        
-        # Remove chapter from fetch_queue if in local_catalog
-        for remote_chapter in chapter_list:
-            for local_chapter in comic.chapters:
-                if remote_chapter.id == local_chapter.id:
-                    page_fetch_queue.remove(remote_chapter)
-    
+    # Every chapter is new unless updating, in which case only the chapters
+    # missing from the local catalog need their pages fetched.
+    diff = diff_chapters(comic.chapters if update else [], chapter_list)
 
-    ordered_chapter_list = []
+    if update and not diff.added and not diff.removed:
+        return comic.chapters
     
-    # Build an ordered chapter list
-    for chapter in chapter_list:
-
-        # If chapter in queue, then download it and update the chapter object 
-        # and then add it to the ordered list
-        if chapter in page_fetch_queue:
-            log.debug(f"Updating chapter {chapter.slug} - {comic.name} from remote catalog.")
-            pages = get_chapter_pages(output_dir, comic, chapter, cache)
-            if pages == "paywall":
-                continue # Skip adding chapter if paywalled.
-
-            chapter.pages = pages
-            ordered_chapter_list.append(chapter)
-        else:
-            # If chapter not in queue, then use the local catalog comic object 
-            # and then add it to the ordered list
-            for i in comic.chapters:
-                if chapter.id == i.id:
-                    ordered_chapter_list.append(i)
-                    break
-
-    return ordered_chapter_list
+    # Resolve the pages of all added chapters through the shared executor.
+    executor = get_page_executor(workers)
+    page_futures = {}
+    for chapter in diff.added:
+        log.debug(f"Updating chapter {chapter.slug} - {comic.name} from remote catalog.")
+        page_futures[chapter.id] = executor.submit(get_chapter_pages, output_dir, comic, chapter, cache)
+
+    paywalled = set()
+    for chapter in diff.added:
+        pages = page_futures[chapter.id].result()
+        if pages == "paywall":
+            paywalled.add(chapter.id) # Skip adding chapter if paywalled.
+            continue
+        chapter.pages = pages
+
+    # Paywalled chapters are remembered, so that updates can tell whether the
+    # remote chapter count adds up. Previously paywalled chapters that were not
+    # listed this time keep their place.
+    previous = set(comic.paywalled) if update else set()
+    comic.paywalled = sorted((previous - {chapter.id for chapter in diff.added}) | paywalled)
+
+    return merge_chapters(chapter_list, diff, skipped=paywalled)
 
 
 def dump_catalog(output_dir:Path, catalog:dict) -> dict:
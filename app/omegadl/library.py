@@ -0,0 +1,145 @@
+import atexit
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+
+MANIFEST_NAME = ".omegadl-library.json"
+
+# Folders modified this recently are rescanned on the next refresh even if
+# their mtime did not change, in case a file was added within the resolution of
+# the file system's timestamps right after they were scanned.
+RACY_SECONDS = 2
+
+_libraries: dict[str, "LibraryIndex"] = {}
+_libraries_lock = threading.Lock()
+
+
+def get_library(library_path:Path) -> "LibraryIndex":
+    """
+    Returns the index of the given library, refreshed the first time it is
+    requested in this process.
+    """
+    key = os.path.abspath(library_path)
+
+    with _libraries_lock:
+        if key not in _libraries:
+            library = LibraryIndex(key)
+            library.refresh()
+            _libraries[key] = library
+        return _libraries[key]
+
+
+def record_archive(path:Path):
+    """
+    Adds a chapter archive that was just written to the index of its library,
+    if that library has been indexed in this process.
+    """
+    path = os.path.abspath(path)
+    series_dir = os.path.dirname(path)
+
+    with _libraries_lock:
+        library = _libraries.get(os.path.dirname(series_dir))
+
+    if library is not None:
+        library.add(os.path.basename(series_dir), os.path.basename(path))
+
+
+class LibraryIndex:
+    """
+    Index of the chapter archives in a library, so that checking whether a
+    chapter is downloaded is a dict lookup instead of a stat on what may be a
+    network mount. It is stored in the library root along with the mtime of
+    every series folder. A refresh lists the library root and only rescans the
+    folders whose mtime changed.
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self.manifest_path = os.path.join(path, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._folders: dict[str, tuple[int, set]] = {}
+        # folder name -> (mtime in ns, names of the files in it)
+        self._dirty = False
+
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.loads(f.read())
+            self._folders = {name: (folder["mtime"], set(folder["files"]))
+                             for name, folder in manifest["folders"].items()}
+        except (OSError, json.JSONDecodeError, KeyError, TypeError):
+            pass
+
+        atexit.register(self.save)
+
+    def _mtime(self, mtime:int) -> int:
+        # Recently modified folders are stored with an mtime that never matches.
+        if time.time_ns() - mtime < RACY_SECONDS * 1_000_000_000:
+            return -1
+        return mtime
+
+    def refresh(self):
+        """
+        Brings the index up to date with the library on disk.
+        """
+        try:
+            entries = [entry for entry in os.scandir(self.path) if entry.is_dir()]
+        except FileNotFoundError:
+            entries = []
+
+        with self._lock:
+            seen = set()
+            for entry in entries:
+                seen.add(entry.name)
+                mtime = entry.stat().st_mtime_ns
+                folder = self._folders.get(entry.name)
+                if folder is not None and folder[0] == mtime:
+                    continue
+
+                try:
+                    files = {file.name for file in os.scandir(entry.path) if file.is_file()}
+                except FileNotFoundError:
+                    continue
+                self._folders[entry.name] = (self._mtime(mtime), files)
+                self._dirty = True
+
+            for name in set(self._folders) - seen:
+                del self._folders[name]
+                self._dirty = True
+
+        self.save()
+
+    def contains(self, path:Path) -> bool:
+        """
+        Returns True if the file at path, a file in a series folder of the
+        library, is in the index.
+        """
+        folder = self._folders.get(os.path.basename(os.path.dirname(path)))
+        return folder is not None and os.path.basename(path) in folder[1]
+
+    def add(self, folder_name:str, file_name:str):
+        """
+        Adds a file written by this process. The folder is still rescanned on
+        the next refresh, in case something else wrote to it as well.
+        """
+        with self._lock:
+            _, files = self._folders.get(folder_name, (-1, set()))
+            files.add(file_name)
+            self._folders[folder_name] = (-1, files)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or not os.path.isdir(self.path):
+                return
+
+            partial_path = f"{self.manifest_path}.part"
+            with open(partial_path, "w") as f:
+                f.write(json.dumps({
+                    "folders": {name: {"mtime": mtime, "files": sorted(files)}
+                                for name, (mtime, files) in self._folders.items()}
+                }))
+            os.replace(partial_path, self.manifest_path)
+            self._dirty = False
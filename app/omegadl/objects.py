@@ -1,10 +1,14 @@
 from enum import Enum
 from pathlib import Path
 import os
+import sys
 import json
-from dataclasses import dataclass, asdict
+from array import array
+from collections.abc import Sequence
+from dataclasses import dataclass, asdict, field
 
 from omegadl.utils import trailing_int
+from omegadl.library import get_library
 
 # Implement a modularized task processor.
 
@@ -21,7 +25,60 @@ class BreakPointOperators(Enum):
     DELTE = 'delete'
     MODIFY = 'modify'
 
+class PageList(Sequence):
+    """
+    Read only list of the page urls of a chapter. The urls of a chapter only
+    differ in their last few characters, so their common prefix is stored once
+    (interned, so equal prefixes are shared) and the rest of every url is packed
+    into a single string with an array of offsets into it.
+    """
+
+    __slots__ = ("_prefix", "_suffixes", "_offsets")
+
+    def __init__(self, urls=()):
+        urls = list(urls)
+        prefix = os.path.commonprefix(urls) if urls else ""
+
+        offsets = [0]
+        for url in urls:
+            offsets.append(offsets[-1] + len(url) - len(prefix))
+
+        self._prefix = sys.intern(prefix)
+        self._suffixes = "".join(url[len(prefix):] for url in urls)
+        self._offsets = array("I", offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("page index out of range")
+
+        return self._prefix + self._suffixes[self._offsets[index]:self._offsets[index + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._prefix + self._suffixes[self._offsets[i]:self._offsets[i + 1]]
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (PageList, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"PageList({list(self)!r})"
+
+
 class Chapter:
+    __slots__ = ("name", "id", "slug", "thumbnail_url", "created_at", "_pages")
+
     def __init__(self, name, id, slug, thumbnail_url, created_at=None):
         self.name = name
         self.id = id
@@ -32,15 +89,25 @@ class Chapter:
         if self.slug == "epilogue":
             self.slug = "chapter-999"
 
-        self.pages:list[str] = []
+        self.pages = []
 
+    @property
+    def pages(self) -> PageList:
+        return self._pages
 
-    def is_downloaded(self, comic,library:Path) -> bool:
+    @pages.setter
+    def pages(self, pages:list[str]):
+        self._pages = pages if isinstance(pages, PageList) else PageList(pages)
 
+    def archive_path(self, comic, library:Path) -> Path:
+        """
+        Returns the path of the chapter's .cbz in the library.
+        """
         vol = self.get_volume(comic)
-        if os.path.exists(library / comic.name / f"{comic.name} Vol.{vol} Ch.{self.slug.split('-')[1]}.cbz"):
-            return True
-        return False
+        return Path(library) / comic.name / f"{comic.name} Vol.{vol} Ch.{self.slug.split('-')[1]}.cbz"
+
+    def is_downloaded(self, comic,library:Path) -> bool:
+        return get_library(library).contains(self.archive_path(comic, library))
 
     def is_breakpoint(self, comic) -> bool:
         if self.slug in comic.volume_breakpoints.keys():
@@ -52,16 +119,7 @@ class Chapter:
         """
         Returns the volume a chapter belongs to in a comic.
         """
-
-        current_volume = 1
-        for chapter in comic.chapters[::-1]:
-            if chapter.is_breakpoint(comic):
-                current_volume = comic.volume_breakpoints[chapter.slug]
-
-            if chapter.slug == self.slug:
-                break
-        
-        return trailing_int(current_volume)
+        return comic.get_volume(self.slug)
 
 
     def encode(self) -> dict:
@@ -71,11 +129,48 @@ class Chapter:
             "slug": self.slug,
             "thumbnail_url": self.thumbnail_url,
             "created_at": self.created_at,
-            "pages": self.pages
+            "pages": list(self.pages)
         }
 
 
+class ChapterList(list):
+    """
+    List of the chapters of a comic that counts how often it was modified, so
+    that the comic can tell when the volumes it worked out are out of date.
+    """
+
+    __slots__ = ("version",)
+
+    def __init__(self, chapters=()):
+        super().__init__(chapters)
+        self.version = 0
+
+    def __reduce__(self):
+        # Unpickling would otherwise add the chapters before version is set.
+        return ChapterList, (list(self),)
+
+
+def _counted(name:str):
+    method = getattr(list, name)
+
+    def mutate(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+
+    mutate.__name__ = name
+    return mutate
+
+
+for _name in ("__setitem__", "__delitem__", "__iadd__", "__imul__", "append", "extend", "insert", "pop", 
+              "remove", "clear", "sort", "reverse"):
+    setattr(ChapterList, _name, _counted(_name))
+
+
 class Comic:
+    __slots__ = ("name", "id", "slug", "status", "updated_at", "created_at", "covers", "paywalled", 
+                 "_chapters", "_chapter_loader", "_volume_breakpoints", "_volumes", "_volumes_version", 
+                 "_latest_volume")
+
     def __init__(self, name:str, id:str, slug:str, status:ComicStatus, 
                  created_at:str, updated_at:str, covers:dict):
         self.name = name
@@ -85,11 +180,52 @@ class Comic:
         self.updated_at = updated_at
         self.created_at = created_at
         self.covers = covers # {"volume":"url"}
+        self.paywalled:list = []
+        # Ids of the chapters left out of the catalog because they were paywalled.
 
-        self.chapters:list[Chapter] = []
+        self._chapters:ChapterList = ChapterList()
+        self._chapter_loader = None
 
         self.volume_breakpoints:dict = {}
         # Stores a {chapter_slug:volume} pair that tells when a new volume starts.
+
+        self._volumes:dict = None
+        # {chapter_slug:volume} for every chapter, built on demand by get_volume().
+        self._volumes_version = 0
+        self._latest_volume = None
+    
+    @property
+    def chapters(self) -> list[Chapter]:
+        if self._chapter_loader is not None:
+            self._chapters = ChapterList(self._chapter_loader())
+            self._chapter_loader = None
+        return self._chapters
+
+    @chapters.setter
+    def chapters(self, chapters:list[Chapter]):
+        # The chapters are copied into a ChapterList, changes to the given list
+        # do not carry over.
+        self._chapters = chapters if isinstance(chapters, ChapterList) else ChapterList(chapters)
+        self._chapter_loader = None
+        self._volumes = None
+
+    @property
+    def volume_breakpoints(self) -> dict:
+        return self._volume_breakpoints
+
+    @volume_breakpoints.setter
+    def volume_breakpoints(self, volume_breakpoints:dict):
+        self._volume_breakpoints = volume_breakpoints
+        self._volumes = None
+
+    def defer_chapters(self, loader):
+        """
+        Sets a callable that returns the chapters of the comic. It is only called
+        once the chapters are first accessed.
+        """
+        self._chapters = ChapterList()
+        self._chapter_loader = loader
+        self._volumes = None
     
     def is_subscribed(self, config) -> bool:
         if config.subscription_list is None:
@@ -106,6 +242,28 @@ class Comic:
                 del self.volume_breakpoints[chapter_slug]
             case BreakPointOperators.MODIFY:
                 self.volume_breakpoints[chapter_slug] = volume_name
+        self._volumes = None
+
+    def get_volume(self, chapter_slug:str) -> str:
+        """
+        Returns the volume the chapter with the given slug belongs to. The
+        volume of every chapter is worked out in one pass over the chapters and
+        kept until the chapters or the breakpoints change.
+        """
+        chapters = self.chapters
+        # Chapters added, removed or replaced in place also invalidate the map.
+        if self._volumes is None or self._volumes_version != chapters.version:
+            self._volumes = {}
+            current_volume = 1
+            for chapter in chapters[::-1]:
+                if chapter.slug in self.volume_breakpoints:
+                    current_volume = self.volume_breakpoints[chapter.slug]
+                self._volumes.setdefault(chapter.slug, trailing_int(current_volume))
+            self._volumes_version = chapters.version
+            # Chapters that are not part of the comic get the volume of its latest chapter.
+            self._latest_volume = trailing_int(current_volume)
+
+        return self._volumes.get(chapter_slug, self._latest_volume)
     
     def get_cover(self, chapter:Chapter) -> str:
         chapter_volume = chapter.get_volume(self)
@@ -123,6 +281,7 @@ class Comic:
             "updated_at": self.updated_at,
             "created_at": self.created_at,
             "covers": self.covers,
+            "paywalled": self.paywalled,
             "chapters": _chapters,
             "volume_breakpoints": self.volume_breakpoints
         }
@@ -147,7 +306,33 @@ class Config:
     cache: bool = True
     output_path: Path = None
     overwrite_catalog: bool = True
+    catalog_backend: str = "json"
+    # Where the catalog is stored, "json" (catalog.json) or "sqlite" (catalog.db).
     download_reverse_order: bool = True
+    download_workers: int = 8
+    # Number of pages fetched in parallel from the image host per chapter.
+    packaging_workers: int = 2
+    # Number of processes rendering covers and finishing archives while pages download.
+    packaging_queue: int = 4
+    # Number of downloaded chapters allowed to wait for packaging before downloads pause.
+    render_memory_mb: int = 256
+    # Memory each cover rendering process can map on top of what it starts with, 0 for no limit. Covers
+    # the images decoded by a render and the layers the process keeps cached.
+    fetch_workers: int = 4
+    # Number of requests made in parallel to the omegascans api.
+    pool_size: int = 16
+    # Number of keep-alive connections pooled per host.
+    request_timeout: float = 30
+    request_retries: int = 3
+    rate_limits: dict = field(default_factory=lambda: {"api.omegascans.org": 4})
+    # Requests per second allowed for each host. Hosts not listed are only limited by concurrency.
+    cache_ttls: dict = field(default_factory=lambda: {"query": 3600, "chapter_list": 3600})
+    # Seconds after which cached responses of an endpoint expire. Missing or null never expire.
+    cache_max_mb: int = 512
+    cache_revalidate: bool = False
+    # Revalidate cached listings with the server (ETag/Last-Modified) instead of trusting their ttl.
+    pull_budget_mb: int = 100
+    # Estimated size up to which pull downloads chapters without asking. The rest is asked for at the end.
         
 
     def load(self, output_dir:Path=None):
@@ -158,7 +343,7 @@ class Config:
             config_dict = json.loads(file.read())
 
         for key, value in config_dict.items():
-            if key.endswith("path"):
+            if key.endswith("path") and value is not None:
                 value = Path(value)
             setattr(self, key, value)
 
@@ -210,6 +395,9 @@ def dict_to_comic(comic_dict:dict) -> Comic:
         chapters = [dict_to_chapter(x) for x in comic_dict["chapters"]]
         comic_obj.chapters = chapters
     
+    if "paywalled" in comic_dict:
+        comic_obj.paywalled = comic_dict["paywalled"]
+
     if "volume_breakpoints" in comic_dict:
         comic_obj.volume_breakpoints = comic_dict["volume_breakpoints"]
         if comic_dict["volume_breakpoints"] == {}:
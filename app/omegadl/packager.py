@@ -0,0 +1,109 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from pathlib import Path
+
+from omegadl.archive import ChapterArchive
+from omegadl.downloader import submit_chapter_covers
+from omegadl.covers import limit_memory
+from omegadl.objects import Comic, Chapter
+
+
+class PackagingStage:
+    """
+    Packages chapters on a process pool so that cover rendering never stalls the
+    network loop. The covers of a download queue can be rendered in one batch
+    up front with prerender(); otherwise the downloader asks for a chapter's
+    cover as soon as it starts on it. It then hands over the archive once its
+    pages are in, and the cover is added and the archive committed once it has
+    been rendered. At most max_pending chapters wait to be packaged, after which
+    package() blocks until the oldest one is done.
+    #   output_dir: Output directory of omegadl, used for the image cache
+    #   workers: Number of worker processes
+    #   max_pending: Number of chapters that can wait to be packaged at once
+    #   memory_limit_mb: Memory each worker process can map on top of what it 
+    #                    starts with, 0 for none
+    #   asset_workers: Number of threads downloading the images covers are
+    #                  rendered from
+    """
+
+    def __init__(self, output_dir:Path, workers:int=2, max_pending:int=4, memory_limit_mb:int=0, 
+                 asset_workers:int=8):
+        self.output_dir = output_dir
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ProcessPoolExecutor(max_workers=workers, initializer=limit_memory, 
+                                             initargs=(memory_limit_mb,))
+        self._asset_executor = ThreadPoolExecutor(max_workers=asset_workers, thread_name_prefix="omegadl-covers")
+        self._covers: dict[tuple, Future] = {}
+        self._pending = deque()
+
+    def prerender(self, comic:Comic, chapters:list[Chapter]):
+        """
+        Starts rendering the covers of all the given chapters as one batch,
+        sharing the base layers of each volume between them.
+        """
+        covers = submit_chapter_covers(self._executor, [(comic, chapter) for chapter in chapters],
+                                       self.output_dir, self._asset_executor)
+        for chapter, cover in zip(chapters, covers):
+            self._covers[(comic.id, chapter.id)] = cover
+
+    def render(self, comic:Comic, chapter:Chapter) -> Future:
+        """
+        Returns a future for the cover of a chapter, starting to render it unless
+        it was prerendered.
+        """
+        cover = self._covers.pop((comic.id, chapter.id), None)
+        if cover is None:
+            cover = submit_chapter_covers(self._executor, [(comic, chapter)], self.output_dir, 
+                                          self._asset_executor)[0]
+        return cover
+
+    def package(self, archive:ChapterArchive, cover:Future, on_done=None):
+        """
+        Queues an archive whose pages have all been written to be finished with
+        its cover. on_done is called once it has been committed.
+        """
+        self._pending.append((archive, cover, on_done))
+        self._finish(block=False)
+
+        while len(self._pending) > self.max_pending:
+            self._finish_oldest()
+
+    def _finish_oldest(self):
+        archive, cover, on_done = self._pending.popleft()
+        try:
+            archive.write("cover.jpg", cover.result())
+        except BaseException as e:
+            archive.abort()
+            raise e
+
+        archive.commit()
+
+        if on_done is not None:
+            on_done()
+
+    def _finish(self, block:bool):
+        # Archives are finished in submission order.
+        while self._pending and (block or self._pending[0][1].done()):
+            self._finish_oldest()
+
+    def close(self):
+        """
+        Waits for every queued chapter to be packaged and stops the workers.
+        """
+        try:
+            self._finish(block=True)
+        finally:
+            for archive, cover, _ in self._pending:
+                cover.cancel()
+                archive.abort()
+            self._pending.clear()
+            self._covers.clear()
+            self._asset_executor.shutdown(cancel_futures=True)
+            self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
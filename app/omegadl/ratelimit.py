@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+# Status codes that mean the server wants us to slow down.
+THROTTLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class HostLimiter:
+    """
+    Paces the requests made to a single host. A token bucket caps the request
+    rate while an AIMD window caps the number of requests in flight: the window
+    grows by one after a full window of successful requests and is halved
+    whenever the server throttles us. A Retry-After from the server pauses all
+    requests to the host until it has passed.
+    #   rate: Requests per second, None for no rate limit
+    #   burst: Number of requests that can be made at once after being idle
+    #   max_concurrency: Upper bound of the in flight window
+    """
+
+    def __init__(self, rate:float=None, burst:int=1, max_concurrency:int=8):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def _refill(self, now:float):
+        if self.rate is None:
+            return
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self):
+        """
+        Blocks until a request can be made to the host.
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait = self._blocked_until - now
+                if wait <= 0 and self._in_flight >= int(self.concurrency):
+                    wait = None
+                elif wait <= 0 and self.rate is not None and self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+
+                if wait is not None and wait <= 0:
+                    break
+                self._condition.wait(wait)
+
+            self._in_flight += 1
+            if self.rate is not None:
+                self._tokens -= 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def succeeded(self):
+        """
+        Additive increase: Widen the window after a full window of successes.
+        """
+        with self._condition:
+            self._successes += 1
+            if self._successes >= int(self.concurrency):
+                self._successes = 0
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                self._condition.notify_all()
+
+    def throttled(self, retry_after:float=None):
+        """
+        Multiplicative decrease: Halve the window and pause the host for
+        retry_after seconds if the server asked for it.
+        """
+        with self._condition:
+            self._successes = 0
+            self.concurrency = max(1.0, self.concurrency / 2)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def parse_retry_after(value:str) -> float:
+    """
+    Returns the number of seconds to wait from a Retry-After header, which holds
+    either a number of seconds or an http date.
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt:int, base:float=0.5, cap:float=30.0) -> float:
+    """
+    Returns an exponential backoff delay with full jitter for the given attempt.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,200 @@
+import heapq
+import json
+import math
+import os
+import re
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+
+
+# Titles are matched on trigrams, the sets of three consecutive characters of
+# each word, padded so that the start and end of words count as well. Two
+# titles that differ by a typo still share most of their trigrams.
+
+MIN_SCORE = 0.5
+# Fraction of the query's trigrams a title has to contain to be a candidate.
+
+_non_alphanumeric = re.compile(r"[\W_]+")
+
+
+def normalize(text:str) -> str:
+    return _non_alphanumeric.sub(" ", text.lower()).strip()
+
+
+def trigrams(text:str) -> set[str]:
+    grams = set()
+    for word in normalize(text).split():
+        word = f"  {word} "
+        for i in range(len(word) - 2):
+            grams.add(word[i:i+3])
+    return grams
+
+
+class TitleIndex:
+    """
+    Inverted trigram index over the titles and slugs of the catalog. Each
+    trigram maps to the slots of the titles containing it, so a search only
+    looks at titles that share at least one trigram with the query.
+    """
+
+    def __init__(self, titles=()):
+        self._titles: list[tuple] = []
+        # (comic id, space stripped lowercase name, number of trigrams) per slot
+        self._slots: dict = {}
+        # comic id -> slot
+        self._postings: dict[str, array] = {}
+
+        for id, name, slug in titles:
+            self.add(id, name, slug)
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def add(self, id, name:str, slug:str):
+        """
+        Adds a title to the index, replacing the previous title of the comic.
+        """
+        if id in self._slots:
+            self.remove(id)
+
+        grams = trigrams(name) | trigrams(slug.replace("-", " "))
+        slot = len(self._titles)
+        self._titles.append((id, name.lower().replace(" ", ""), len(grams)))
+        self._slots[id] = slot
+
+        for gram in grams:
+            if gram not in self._postings:
+                self._postings[gram] = array("I")
+            self._postings[gram].append(slot)
+
+    def remove(self, id):
+        """
+        Removes the title of a comic. Its slot is left empty and skipped by
+        searches until the index is rebuilt.
+        """
+        slot = self._slots.pop(id, None)
+        if slot is not None:
+            self._titles[slot] = None
+
+    def search(self, query:str, limit:int=10, accept=None) -> list:
+        """
+        Returns the ids of up to limit comics best matching the query, best
+        first. Titles are ranked by the number of trigrams they share with the
+        query, then by whether they contain the query as is (ignoring case and
+        spaces), then by how few other trigrams they have.
+        #   accept: Called with the id of every candidate, those it returns False
+        #           for are left out of the results
+        """
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        # A title sharing at least minimum trigrams with the query contains one
+        # of its len - minimum + 1 rarest trigrams, so only those posting lists
+        # are walked. The titles found are then looked up in the remaining, 
+        # longer posting lists, which are sorted.
+        grams = sorted(query_grams, key=lambda gram: len(self._postings.get(gram, ())))
+        minimum = math.ceil(MIN_SCORE * len(grams))
+        probes = len(grams) - minimum + 1
+        remaining = [self._postings.get(gram, ()) for gram in grams[probes:]]
+
+        candidates = Counter()
+        for gram in grams[:probes]:
+            candidates.update(self._postings.get(gram, ()))
+
+        substring = query.lower().replace(" ", "")
+        top_counts = []
+        ranked = []
+        for slot, count in candidates.most_common():
+            # The count a title needs to make it into the results.
+            needed = minimum
+            if len(top_counts) == limit:
+                needed = max(minimum, top_counts[0])
+
+            # Candidates come in decreasing order of their count so far. Once
+            # even matching every remaining trigram cannot get one into the
+            # results, none of the rest can either.
+            if count + len(remaining) < needed:
+                break
+
+            title = self._titles[slot]
+            if title is None or (accept is not None and not accept(title[0])):
+                continue
+
+            for i, postings in enumerate(remaining):
+                if count + len(remaining) - i < needed:
+                    break
+                j = bisect_left(postings, slot)
+                if j < len(postings) and postings[j] == slot:
+                    count += 1
+            if count < needed:
+                continue
+
+            id, stripped, size = title
+            # Jaccard similarity favours titles without many trigrams besides
+            # the query's.
+            ranked.append((count, substring in stripped, count / (len(grams) + size - count), -slot, id))
+
+            if len(top_counts) < limit:
+                heapq.heappush(top_counts, count)
+            elif count > top_counts[0]:
+                heapq.heapreplace(top_counts, count)
+
+        return [ranked_title[-1] for ranked_title in heapq.nlargest(limit, ranked)]
+
+    def encode(self) -> dict:
+        return {
+            "titles": [title for title in self._titles],
+            "postings": {gram: slots.tolist() for gram, slots in self._postings.items()},
+        }
+
+    @classmethod
+    def decode(cls, data:dict) -> "TitleIndex":
+        index = cls()
+        index._titles = [tuple(title) if title is not None else None for title in data["titles"]]
+        index._slots = {title[0]: slot for slot, title in enumerate(index._titles) if title is not None}
+        index._postings = {gram: array("I", slots) for gram, slots in data["postings"].items()}
+        return index
+
+
+def read_title_index(path:Path, fetched:str) -> TitleIndex:
+    """
+    Returns the title index stored at path, or None if there is none or it was
+    built for a catalog synced at a different time.
+    """
+    try:
+        with open(path, "r") as f:
+            data = json.loads(f.read())
+    except (OSError, json.JSONDecodeError):
+        return None
+
+    if fetched is None or data.get("fetched") != fetched:
+        return None
+    return TitleIndex.decode(data)
+
+
+def write_title_index(path:Path, index:TitleIndex, fetched:str):
+    partial_path = path.with_name(f"{path.name}.part")
+    with open(partial_path, "w") as f:
+        f.write(json.dumps({"fetched": fetched, **index.encode()}))
+    os.replace(partial_path, path)
+
+
+def load_title_index(path:Path, fetched:str, titles) -> TitleIndex:
+    """
+    Returns the title index of a catalog. The index stored at path is used if
+    it was built for the catalog synced at fetched, otherwise it is built from
+    titles(), an iterable of (id, name, slug), and stored at path. path can be
+    None for catalogs that are not stored anywhere.
+    """
+    if path is not None:
+        index = read_title_index(path, fetched)
+        if index is not None:
+            return index
+
+    index = TitleIndex(titles())
+    if path is not None and fetched is not None:
+        write_title_index(path, index, fetched)
+    return index
@@ -0,0 +1,129 @@
+import threading
+import time
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from omegadl.objects import Config
+from omegadl.ratelimit import HostLimiter, THROTTLE_STATUS_CODES, parse_retry_after, backoff_delay
+
+
+log = logging.getLogger("rich")
+
+
+# One long lived session is kept per host (api.omegascans.org, the image cdn, ...)
+# so that connections are reused instead of doing a new TCP+TLS handshake for
+# every api call and every image.
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+# Every host also gets its own limiter so that throttling by the api does not
+# slow down image downloads from the cdn and vice versa.
+_limiters: dict[str, HostLimiter] = {}
+
+_settings = {
+    "pool_size": 16,
+    "timeout": 30,
+    "retries": 3,
+    "rate_limits": {},
+}
+
+
+def configure(config:Config):
+    """
+    Applies the transport settings from the config. Existing sessions are closed
+    so that the new pool sizes and retry policies take effect.
+    """
+    _settings["pool_size"] = config.pool_size
+    _settings["timeout"] = config.request_timeout
+    _settings["retries"] = config.request_retries
+    _settings["rate_limits"] = config.rate_limits
+    close()
+
+
+def close():
+    """
+    Closes all pooled sessions.
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _limiters.clear()
+
+
+def _new_session() -> requests.Session:
+    # Retries are handled by get() so that they go through the host's limiter.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_settings["pool_size"], max_retries=0)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url:str) -> requests.Session:
+    """
+    Returns the pooled session for the host of the given url.
+    """
+    host = urlsplit(url).netloc
+
+    with _sessions_lock:
+        if host not in _sessions:
+            _sessions[host] = _new_session()
+        return _sessions[host]
+
+
+def get_limiter(url:str) -> HostLimiter:
+    """
+    Returns the rate limiter for the host of the given url.
+    """
+    host = urlsplit(url).netloc
+
+    with _sessions_lock:
+        if host not in _limiters:
+            rate = _settings["rate_limits"].get(host)
+            _limiters[host] = HostLimiter(rate=rate, burst=max(1, int(rate or 1)), 
+                                          max_concurrency=_settings["pool_size"])
+        return _limiters[host]
+
+
+def get(url:str, **kwargs) -> requests.Response:
+    """
+    Makes a GET request through the pooled session and the limiter of the url's
+    host. Connection errors and throttling responses (429/5xx) are retried with 
+    jittered exponential backoff, honouring Retry-After. The last response is 
+    returned once the retries run out.
+    """
+    kwargs.setdefault("timeout", _settings["timeout"])
+    session = get_session(url)
+    limiter = get_limiter(url)
+    retries = _settings["retries"]
+
+    for attempt in range(retries + 1):
+        try:
+            with limiter:
+                response = session.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            limiter.throttled()
+            if attempt == retries:
+                raise e
+            log.debug(f"Retrying {url} after {e.__class__.__name__}")
+            time.sleep(backoff_delay(attempt))
+            continue
+
+        if response.status_code not in THROTTLE_STATUS_CODES:
+            limiter.succeeded()
+            return response
+
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        limiter.throttled(retry_after)
+        if attempt == retries:
+            return response
+
+        log.debug(f"Retrying {url} after status code {response.status_code}")
+        response.close()
+        if retry_after is None:
+            time.sleep(backoff_delay(attempt))
@@ -0,0 +1,94 @@
+"""
+Benchmarks the memory taken by a catalog held in memory.
+
+A synthetic catalog shaped like the omegascans one is built comic by comic and
+measured with tracemalloc, once as Comic/Chapter objects and once with the
+representation used before they had slots and compact page lists (attribute
+dicts holding plain lists of url strings). No network access is needed:
+
+    python benchmarks/bench_catalog_memory.py --comics 2000 --chapters 60 --pages 30
+"""
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from omegadl.objects import dict_to_comic
+
+
+def generate_catalog(comics:int, chapters:int, pages:int):
+    """
+    Yields comic dicts in the format of catalog.json. Every string is built
+    fresh, as it would be when parsed from the file.
+    """
+    for i in range(comics):
+        slug = f"synthetic-comic-{i}"
+        yield {
+            "name": f"Synthetic Comic {i}",
+            "id": i,
+            "slug": slug,
+            "status": "ONGOING",
+            "updated_at": "2024-01-01T00:00:00.000Z",
+            "created_at": "2023-01-01T00:00:00.000Z",
+            "covers": {"01": f"https://media.omegascans.org/file/4SRBHm/uploads/series/{slug}/cover.jpg"},
+            "volume_breakpoints": {"chapter-1": "01"},
+            "chapters": [{
+                "name": f"Chapter {j}",
+                "id": i * chapters + j,
+                "slug": f"chapter-{j}",
+                "thumbnail_url": f"https://media.omegascans.org/file/4SRBHm/uploads/series/{slug}/chapter-{j}.jpg",
+                "created_at": "2023-06-01T00:00:00.000Z",
+                "pages": [f"https://media.omegascans.org/file/4SRBHm/uploads/series/{slug}/chapter-{j}/{k:02d}.jpg"
+                          for k in range(pages)],
+            } for j in range(chapters, 0, -1)],
+        }
+
+
+def legacy_comic(comic_dict:dict) -> SimpleNamespace:
+    chapters = [SimpleNamespace(name=chapter["name"], id=chapter["id"], slug=chapter["slug"],
+                                thumbnail_url=chapter["thumbnail_url"], created_at=chapter["created_at"],
+                                pages=chapter["pages"])
+                for chapter in comic_dict["chapters"]]
+    return SimpleNamespace(name=comic_dict["name"], id=comic_dict["id"], slug=comic_dict["slug"],
+                           status=comic_dict["status"], updated_at=comic_dict["updated_at"],
+                           created_at=comic_dict["created_at"], covers=comic_dict["covers"], chapters=chapters,
+                           volume_breakpoints=comic_dict["volume_breakpoints"])
+
+
+def measure(build, args) -> tuple[float, float]:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    catalog = [build(comic) for comic in generate_catalog(args.comics, args.chapters, args.pages)]
+
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del catalog
+    return size / 1024 / 1024, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--comics", type=int, default=2000)
+    parser.add_argument("--chapters", type=int, default=60, help="Chapters per comic")
+    parser.add_argument("--pages", type=int, default=30, help="Pages per chapter")
+    args = parser.parse_args()
+
+    urls = args.comics * args.chapters * args.pages
+    print(f"{args.comics} comics, {args.comics * args.chapters} chapters, {urls} page urls")
+
+    for label, build in (("dict + list[str]", legacy_comic), ("slots + PageList", dict_to_comic)):
+        size, elapsed = measure(build, args)
+        print(f"{label:>18}: {size:8.1f} MB  ({elapsed:.1f}s to build)")
+
+
+if __name__ == "__main__":
+    main()
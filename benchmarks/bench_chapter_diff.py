@@ -0,0 +1,86 @@
+"""
+Benchmarks the chapter diff done when updating a comic.
+
+Synthetic local and remote chapter lists are compared with the nested loop diff
+get_chapters used before and with chapterdiff, and both results are checked to
+be the same. No network access is needed:
+
+    python benchmarks/bench_chapter_diff.py --chapters 500 2000 5000 --new 5
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from omegadl.chapterdiff import diff_chapters, merge_chapters
+from omegadl.objects import Chapter
+
+
+def build_lists(chapters:int, new:int, removed:int) -> tuple[list[Chapter], list[Chapter]]:
+    """
+    Returns (local, remote) newest first. The remote list has new chapters the
+    local one lacks, and lacks a few chapters the local one has.
+    """
+    def chapter(i):
+        return Chapter(name=f"Chapter {i}", id=i, slug=f"chapter-{i}", thumbnail_url=None)
+
+    local = [chapter(i) for i in range(chapters, 0, -1)]
+    gone = set(random.sample(range(1, chapters + 1), removed))
+    remote = [chapter(i) for i in range(chapters + new, 0, -1) if i not in gone]
+    return local, remote
+
+
+def nested_loop_merge(local:list[Chapter], remote:list[Chapter]) -> list[Chapter]:
+    page_fetch_queue = remote.copy()
+    for remote_chapter in remote:
+        for local_chapter in local:
+            if remote_chapter.id == local_chapter.id:
+                page_fetch_queue.remove(remote_chapter)
+
+    ordered_chapter_list = []
+    for chapter in remote:
+        if chapter in page_fetch_queue:
+            ordered_chapter_list.append(chapter)
+        else:
+            for i in local:
+                if chapter.id == i.id:
+                    ordered_chapter_list.append(i)
+                    break
+    return ordered_chapter_list
+
+
+def diff_merge(local:list[Chapter], remote:list[Chapter]) -> list[Chapter]:
+    return merge_chapters(remote, diff_chapters(local, remote))
+
+
+def timed(function, *args) -> tuple[float, list]:
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chapters", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--new", type=int, default=3, help="Chapters only present remotely")
+    parser.add_argument("--removed", type=int, default=2, help="Chapters only present locally")
+    args = parser.parse_args()
+
+    random.seed(0)
+    for chapters in args.chapters:
+        local, remote = build_lists(chapters, args.new, args.removed)
+
+        old_time, old_result = timed(nested_loop_merge, local, remote)
+        new_time, new_result = timed(diff_merge, local, remote)
+        assert [chapter.id for chapter in old_result] == [chapter.id for chapter in new_result]
+        assert all(a is b for a, b in zip(old_result, new_result))
+
+        print(f"{chapters:>6} chapters: nested loop {old_time*1000:9.2f} ms, "
+              f"diff {new_time*1000:7.3f} ms ({old_time/new_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
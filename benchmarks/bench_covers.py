@@ -0,0 +1,78 @@
+"""
+Benchmarks the batch cover renderer against the number of worker processes.
+
+Synthetic volume covers, chapter thumbnails and logos are written to a temporary
+image cache, so no network access is needed. Run from the repository root so
+that the bundled font and logos.json are found:
+
+    python benchmarks/bench_covers.py --chapters 120 --volumes 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from omegadl import covers
+from omegadl.downloader import render_chapter_covers
+from omegadl.objects import Comic, Chapter, ComicStatus
+from omegadl.utils import trailing_int
+
+
+def build_jobs(output_dir:Path, chapters:int, volumes:int) -> list[tuple[Comic, Chapter]]:
+    image_dir = output_dir / "cache" / "images"
+    os.makedirs(image_dir, exist_ok=True)
+
+    # The id has to be present in logos.json for the logo lookup to succeed.
+    comic = Comic(name="Benchmark Comic", id=105, slug="benchmark-comic", status=ComicStatus.ONGOING,
+                  created_at="", updated_at="", covers={})
+
+    comic.chapters = [Chapter(name=f"Chapter {i}", id=i, slug=f"chapter-{i}", thumbnail_url=f"thumbnail-{i}")
+                      for i in range(chapters, 0, -1)]
+
+    per_volume = -(-chapters // volumes)
+    for v in range(volumes):
+        volume = trailing_int(v + 1)
+        comic.volume_breakpoints[f"chapter-{v*per_volume + 1}"] = volume
+        comic.covers[volume] = f"cover-{volume}"
+        Image.new("RGB", (1000, 1500), (40*v, 80, 120)).save(image_dir / f"{comic.id}_cover{volume}.jpg")
+
+    Image.new("RGBA", (800, 300), (255, 255, 255, 200)).save(image_dir / f"{comic.id}_logo.png")
+    for chapter in comic.chapters:
+        Image.new("RGB", (720, 400), (chapter.id % 255, 120, 60)).save(image_dir / f"{comic.id}_{chapter.id}_cover.jpg")
+
+    return [(comic, chapter) for chapter in comic.chapters]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chapters", type=int, default=120)
+    parser.add_argument("--volumes", type=int, default=4)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = Path(tmp)
+        jobs = build_jobs(output_dir, args.chapters, args.volumes)
+
+        print(f"{'workers':>8} {'seconds':>9} {'covers/s':>9}")
+        workers = 1
+        while workers <= args.max_workers:
+            covers.background_layer.cache_clear()
+            covers.logo_layer.cache_clear()
+
+            start = time.perf_counter()
+            render_chapter_covers(jobs, output_dir, output_dir / "covers", workers=workers)
+            elapsed = time.perf_counter() - start
+
+            print(f"{workers:>8} {elapsed:>9.2f} {len(jobs)/elapsed:>9.1f}")
+            workers *= 2
+
+
+if __name__ == "__main__":
+    main()
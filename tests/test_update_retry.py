@@ -0,0 +1,105 @@
+"""
+Checks that an update aborted after the chapter list was cached is redone in
+full by the next update, instead of the cached list counting as unchanged.
+
+    python -m unittest discover tests
+"""
+import json
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from omegadl import cache, fetch
+from omegadl.objects import Comic, Config
+
+
+def chapter_dict(i:int) -> dict:
+    return {"id": i, "chapter_name": f"Chapter {i}", "chapter_slug": f"chapter-{i}", "chapter_thumbnail": None,
+            "created_at": "2024-01-01"}
+
+
+class FakeResponse:
+    def __init__(self, body:dict):
+        self.status_code = 200
+        self.text = json.dumps(body)
+        self.headers = {}
+
+
+class FakeRemote:
+    """
+    Serves chapter lists newest first and chapter pages, failing page requests
+    while fail_pages is set.
+    """
+
+    def __init__(self, chapters:int):
+        self.chapters = [chapter_dict(i) for i in range(chapters, 0, -1)]
+        self.fail_pages = False
+        self.page_requests = []
+
+    def get(self, url:str, **kwargs) -> FakeResponse:
+        endpoint, _ = cache.classify(url)
+        if endpoint == "chapter_list":
+            query = dict(x.split("=") for x in url.split("?")[1].split("&"))
+            page, per_page = int(query["page"]), int(query["perPage"])
+            data = self.chapters[(page - 1) * per_page:page * per_page]
+            return FakeResponse({"meta": {"total": len(self.chapters)}, "data": data})
+
+        self.page_requests.append(url)
+        if self.fail_pages:
+            raise ConnectionError(url)
+        return FakeResponse({"chapter": {"chapter_data": {"images": [f"{url}/1.jpg"]}}})
+
+
+class AbortedUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = Path(tempfile.mkdtemp())
+        cache.configure(Config(cache_revalidate=True))
+        self.remote = FakeRemote(chapters=3)
+
+        patches = [mock.patch.object(fetch.transport, "get", self.remote.get),
+                   mock.patch.object(fetch, "read_cookies", dict)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(cache.configure, Config())
+
+        self.comic = Comic(name="Comic", id=1, slug="comic", status=None, created_at=None, updated_at=None,
+                           covers=[])
+        self.comic.chapters = fetch.get_chapters(self.output_dir, self.comic, False, True)
+        self.synced_at = time.time()
+
+    def update(self) -> list:
+        return fetch.get_chapters(self.output_dir, self.comic, True, True, synced_at=self.synced_at)
+
+    def test_unchanged_list_is_skipped(self):
+        self.remote.page_requests.clear()
+        self.assertIs(self.update(), self.comic.chapters)
+        self.assertEqual(self.remote.page_requests, [])
+
+    def test_retry_after_abort_fetches_new_chapters(self):
+        self.remote.chapters.insert(0, chapter_dict(4))
+
+        # The chapter list is cached, but the catalog is never saved.
+        self.remote.fail_pages = True
+        with self.assertRaises(ConnectionError):
+            self.update()
+
+        self.remote.fail_pages = False
+        chapters = self.update()
+        self.assertEqual([chapter.id for chapter in chapters], [4, 3, 2, 1])
+        self.assertEqual(chapters[0].pages, ["https://api.omegascans.org/chapter/comic/chapter-4/1.jpg"])
+
+        # Once the catalog is saved with the new chapter, the list is unchanged.
+        self.comic.chapters = chapters
+        self.synced_at = time.time()
+        self.assertIs(self.update(), self.comic.chapters)
+
+
+if __name__ == "__main__":
+    unittest.main()